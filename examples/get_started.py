@@ -5,6 +5,7 @@ from instruct_qa.retrieval.utils import load_retriever, load_index
 from instruct_qa.prompt.utils import load_template
 from instruct_qa.generation.utils import load_model
 from instruct_qa.response_runner import ResponseRunner
+from instruct_qa.cache.utils import load_cache
 
 import pandas as pd
 import glob
@@ -17,7 +18,6 @@ import itertools
 from importlib import reload
 import pickle
 
-import proximipy
 import random
 
 
@@ -73,7 +73,7 @@ for paramlist in itertools.product(seeds_range, cache_capacity_range, cache_tole
             print("loading all")
             mmlu_qs = pd.concat((pd.read_csv(f, names=['question', 'a', 'b', 'c', 'd', 'correct']) for f in all_files), ignore_index=True)
 
-        cache = proximipy.FifoCache(cache_capacity, cache_tolerance)
+        cache = load_cache("fifo", cache_capacity, cache_tolerance)
         reload(instruct_qa)
         from instruct_qa.response_runner import ResponseRunner
 
@@ -116,19 +116,18 @@ for paramlist in itertools.product(seeds_range, cache_capacity_range, cache_tole
         )
         
         # get 30 most likely tokens and find which one does best
-        responses, trags = runner.get_probas(30)
-        with open(f"/mnt/nfs/home/randl/llm-rag/logs/fifo-timings-s{seed}cap{cache_capacity}tol{cache_tolerance}rerank{db_k}.pkl", "wb") as f:
-            pickle.dump(trags, f)
+        responses, stats = runner.get_probas(30)
+        stats.save_npz(f"/mnt/nfs/home/randl/llm-rag/logs/fifo-timings-s{seed}cap{cache_capacity}tol{cache_tolerance}rerank{db_k}.npz")
         best_calls = [find_best_tok(toks) for toks in responses]
 
         # print(best_calls, answers)
-        # print("rag time", np.mean(trags))
+        # print("rag time", stats.summary()["search_p50"])
         # print("total time", time.time() - t1)
-        # print("hit rate", runner.cache_hit / len(responses))
+        # print("hit rate", stats.hit_rate)
         # print(sum([1 if x == y else 0 for (x, y) in zip(best_calls, answers)]), "/", len(answers))
         accuracy = sum([1 if x == y else 0 for (x, y) in zip(best_calls, answers)]) / len(answers)
 
-        results[paramlist] = {"hit rate" : runner.cache_hit / len(responses), "accuracy" : accuracy}
+        results[paramlist] = {"hit rate" : stats.hit_rate, "accuracy" : accuracy, **stats.summary()}
         print(paramlist, results[paramlist])
         
 
@@ -168,6 +168,13 @@ parser.add_argument(
     default=None,
     help="Path to the index to use for retrieval.",
 )
+parser.add_argument(
+    "--index_nprobe",
+    action="store",
+    type=int,
+    default=None,
+    help="Number of inverted lists scanned per query by IVF indexes. Defaults to the value saved with the index.",
+)
 parser.add_argument(
     "--seed",
     action="store",
@@ -264,6 +271,8 @@ if __name__ == "__main__":
         kwargs = {}
         if args.index_path is not None:
             kwargs['index_path'] = args.index_path
+        if args.index_nprobe is not None:
+            kwargs['nprobe'] = args.index_nprobe
         index = load_index(args.index_name, **kwargs)
 
     retriever = None
@@ -0,0 +1,17 @@
+from instruct_qa.cache.proximity_cache import ProximityCache, FifoCache, LruCache, LfuCache
+from instruct_qa.cache.ivf_cache import IVFProximityCache
+from instruct_qa.cache.lsh_cache import LSHProximityCache
+from instruct_qa.cache.server import CacheServer, RemoteProximityCache
+from instruct_qa.cache.text_cache import QueryTextCache
+from instruct_qa.cache.tolerance import AdaptiveToleranceController
+from instruct_qa.cache.simulation import CacheTrace, record_trace, simulate_cache, simulate_caches
+from instruct_qa.cache.answer_cache import SemanticAnswerCache
+
+
+def __getattr__(name):
+    # multiprocessing.shared_memory requires Python 3.8, so the shared cache is only imported on use
+    if name == "SharedMemoryProximityCache":
+        from instruct_qa.cache.shared_cache import SharedMemoryProximityCache
+
+        return SharedMemoryProximityCache
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,129 @@
+import numpy as np
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+class TinyLfuAdmission:
+    name = "tinylfu"
+
+    def __init__(self, capacity, new_array, n_bits=16, depth=4, width=None, sample_size=None, seed=0):
+        """
+        TinyLFU admission filter: a new entry is only written over an occupied
+        slot if it is estimated to be reused more often than the entry it would
+        evict. Reuse is estimated with a count-min sketch over coarse buckets of
+        the embedding space, so that near-duplicate queries share a count. A
+        bucket is the sign pattern of the embedding on `n_bits` random
+        hyperplanes through the origin.
+
+        Every lookup increments the count of its bucket. After `sample_size`
+        lookups all counts are halved, so that the estimates follow recent
+        traffic.
+
+        Parameters
+        ----------
+        capacity: int
+            The number of slots of the cache.
+
+        new_array: callable
+            Function with signature `new_array(name, shape, dtype)` returning a
+            zero-initialized array, as for eviction policies.
+
+        n_bits: int
+            The number of hyperplanes, i.e. the log2 of the number of buckets.
+
+        depth: int
+            The number of rows (hash functions) of the count-min sketch.
+
+        width: int
+            The number of counters per row, rounded up to a power of two.
+            Defaults to 4 times the capacity.
+
+        sample_size: int
+            The number of recorded lookups after which counts are halved.
+            Defaults to 10 times the capacity.
+
+        seed: int
+            Seed of the hyperplanes and of the hash functions.
+        """
+        if not 0 < n_bits <= 63:
+            raise ValueError(f"n_bits must be between 1 and 63. Got {n_bits}.")
+        width = 4 * capacity if width is None else width
+        self.width_bits = max(1, int(np.ceil(np.log2(width))))
+        self.n_bits = n_bits
+        self.sample_size = 10 * capacity if sample_size is None else sample_size
+        self.seed = seed
+
+        rng = np.random.default_rng(seed)
+        self._hash_seeds = rng.integers(0, 2**63, size=depth, dtype=np.int64).astype(np.uint64)
+        self._planes = None
+
+        self.sketch = new_array("admission_sketch", (depth, 2**self.width_bits), np.int32)
+        # bucket of the entry stored in each slot
+        self.buckets = new_array("admission_buckets", (capacity,), np.int64)
+        # [lookups recorded since the last aging, admitted entries, rejected entries]
+        self.counters = new_array("admission_counters", (3,), np.int64)
+
+    @property
+    def admitted(self):
+        return int(self.counters[1])
+
+    @property
+    def rejected(self):
+        return int(self.counters[2])
+
+    def bucket(self, vectors):
+        """The bucket id of each vector, shape (n,)."""
+        if self._planes is None or self._planes.shape[1] != vectors.shape[1]:
+            rng = np.random.default_rng(self.seed)
+            self._planes = rng.standard_normal((self.n_bits, vectors.shape[1])).astype(np.float32)
+        bits = (vectors @ self._planes.T) > 0
+        return bits @ (1 << np.arange(self.n_bits, dtype=np.int64))
+
+    def _rows(self, buckets):
+        """The counter of each bucket in each row of the sketch, shape (depth, n)."""
+        hashed = (buckets.astype(np.uint64)[None, :] ^ self._hash_seeds[:, None]) * _GOLDEN
+        return (hashed >> np.uint64(64 - self.width_bits)).astype(np.int64)
+
+    def estimate(self, buckets):
+        rows = self._rows(buckets)
+        return self.sketch[np.arange(len(rows))[:, None], rows].min(axis=0)
+
+    def record(self, vectors):
+        """Count a batch of lookups."""
+        rows = self._rows(self.bucket(vectors))
+        for sketch_row, row in zip(self.sketch, rows):
+            np.add.at(sketch_row, row, 1)
+        self.counters[0] += len(vectors)
+        if self.counters[0] >= self.sample_size:
+            self.sketch >>= 1
+            self.counters[0] = 0
+
+    def admit(self, keys, slots, valid):
+        """
+        Decide which of the new `keys` are written to their `slots`. Keys going
+        to free slots are always admitted; keys going to occupied slots are
+        admitted if their estimated frequency is higher than the one of the
+        entry they would evict.
+
+        Returns
+        -------
+        numpy.ndarray
+            Boolean mask of shape (len(keys),) of the admitted keys.
+        """
+        buckets = self.bucket(keys)
+        admitted = np.ones(len(keys), dtype=bool)
+        contested = valid[slots]
+        if contested.any():
+            admitted[contested] = (
+                self.estimate(buckets[contested]) > self.estimate(self.buckets[slots[contested]])
+            )
+        self.buckets[slots[admitted]] = buckets[admitted]
+        n_admitted = int(np.count_nonzero(admitted))
+        self.counters[1] += n_admitted
+        self.counters[2] += len(keys) - n_admitted
+        return admitted
+
+
+ADMISSION_NAME_TO_CLASS = {
+    admission.name: admission for admission in [TinyLfuAdmission]
+}
@@ -0,0 +1,132 @@
+import hashlib
+
+import numpy as np
+
+from instruct_qa.cache.utils import load_cache
+
+
+class SemanticAnswerCache:
+    def __init__(self, capacity, tolerance, cache_name="lru", **cache_kwargs):
+        """
+        Cache of generated answers, keyed by query embedding, so that a query
+        close enough to a previous one skips generation entirely. The answer
+        depends on more than the query, so entries are partitioned by a
+        namespace identifying the model, prompt template and any other setting
+        of the generation (see `namespace`); each namespace has its own
+        proximity cache of `capacity` entries.
+
+        Answers are arbitrary Python objects (generated text, top-k tokens,
+        ...). The proximity caches store an integer id per entry, and the
+        answers are kept in a side table, pruned of evicted ids as it grows.
+
+        Parameters
+        ----------
+        capacity: int
+            The maximum number of entries per namespace.
+
+        tolerance: float
+            The maximum euclidean distance between two queries for the answer of
+            the first to be reused for the second. It should be stricter
+            (smaller) than the tolerance of the retrieval cache, since the
+            answer depends on the exact question.
+
+        cache_name: str
+            The proximity cache used for each namespace, see `load_cache`.
+
+        **cache_kwargs: dict
+            Additional keyword arguments passed to the proximity caches.
+        """
+        self.capacity = capacity
+        self.tolerance = tolerance
+        self.cache_name = cache_name
+        self.cache_kwargs = cache_kwargs
+        self.n_lookups = 0
+        self.n_hits = 0
+        self._caches = {}
+        self._answers = {}
+        self._next_id = 0
+
+    @staticmethod
+    def namespace(*identity):
+        """
+        Returns an integer namespace for the given identity, e.g.
+        `namespace(model_name, template_name, k)`. The parts are hashed through
+        their `repr`.
+        """
+        return int(hashlib.sha1(repr(identity).encode()).hexdigest()[:15], 16)
+
+    @property
+    def hit_rate(self):
+        return self.n_hits / self.n_lookups if self.n_lookups > 0 else float("nan")
+
+    def __len__(self):
+        return sum(len(cache) for cache in self._caches.values())
+
+    def clear(self):
+        self._caches = {}
+        self._answers = {}
+
+    def _cache(self, namespace):
+        if namespace not in self._caches:
+            self._caches[namespace] = load_cache(
+                self.cache_name, self.capacity, self.tolerance, **self.cache_kwargs
+            )
+        cache = self._caches[namespace]
+        cache.tolerance = self.tolerance
+        return cache
+
+    def find_batch(self, namespace, embeddings):
+        """
+        Look up the answers of a batch of queries.
+
+        Parameters
+        ----------
+        namespace: int
+            The namespace of the queries, see `namespace`.
+
+        embeddings: numpy.ndarray
+            The query embeddings, of shape (n_queries, dim).
+
+        Returns
+        -------
+        hit_mask: numpy.ndarray
+            Boolean array of shape (n_queries,).
+
+        answers: list
+            For each query, the cached answer if it was a hit, None otherwise.
+        """
+        hit_mask, ids, _ = self._cache(namespace).find_batch(embeddings)
+        answers = [None] * len(hit_mask)
+        for i in np.flatnonzero(hit_mask):
+            answers[i] = self._answers[int(ids[i, 0])]
+        self.n_lookups += len(hit_mask)
+        self.n_hits += int(np.count_nonzero(hit_mask))
+        return hit_mask, answers
+
+    def insert_batch(self, namespace, embeddings, answers):
+        """
+        Insert the answers of a batch of queries.
+
+        Parameters
+        ----------
+        namespace: int
+            The namespace of the queries, see `namespace`.
+
+        embeddings: numpy.ndarray
+            The query embeddings, of shape (n_queries, dim).
+
+        answers: list
+            The answer of each query.
+        """
+        if len(answers) == 0:
+            return
+        ids = np.arange(self._next_id, self._next_id + len(answers), dtype=np.int64)
+        self._next_id += len(answers)
+        self._answers.update(zip(ids.tolist(), answers))
+        self._cache(namespace).insert_batch(embeddings, ids[:, None])
+
+        if len(self._answers) > 2 * self.capacity * len(self._caches):
+            live = set()
+            for cache in self._caches.values():
+                live.update(cache.values()[:, 0].tolist())
+            self._answers = {i: answer for i, answer in self._answers.items() if i in live}
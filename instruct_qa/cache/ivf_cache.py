@@ -0,0 +1,257 @@
+import numpy as np
+
+from instruct_qa.cache.proximity_cache import ProximityCache
+
+
+def kmeans(samples, n_clusters, n_iter=10, seed=0):
+    """
+    Plain Lloyd's k-means on the rows of `samples`.
+
+    Parameters
+    ----------
+    samples: numpy.ndarray
+        Array of shape (n_samples, dim). Must have at least `n_clusters` rows.
+
+    n_clusters: int
+        The number of centroids to compute.
+
+    n_iter: int
+        The number of assignment/update iterations.
+
+    seed: int
+        Seed used to pick the initial centroids among the samples.
+
+    Returns
+    -------
+    numpy.ndarray
+        The centroids, of shape (n_clusters, dim).
+    """
+    rng = np.random.default_rng(seed)
+    centroids = samples[rng.choice(len(samples), n_clusters, replace=False)].copy()
+    sample_sq_norms = np.einsum("ij,ij->i", samples, samples)[:, None]
+
+    for _ in range(n_iter):
+        sq_dist = sample_sq_norms - 2.0 * samples @ centroids.T
+        sq_dist += np.einsum("ij,ij->i", centroids, centroids)
+        assignment = np.argmin(sq_dist, axis=1)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, samples)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        # empty clusters keep their previous centroid
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+
+    return centroids
+
+
+class IVFProximityCache(ProximityCache):
+    def __init__(
+        self,
+        capacity,
+        tolerance,
+        policy="fifo",
+        n_lists=None,
+        n_probe=8,
+        train_size=None,
+        compact_ratio=2.0,
+        **kwargs,
+    ):
+        """
+        Proximity cache whose keys are indexed by an inverted file (IVF), for
+        capacities where a linear scan over all the keys is too slow. Each key is
+        assigned to its closest coarse centroid, and a lookup only computes
+        distances to the keys stored in the `n_probe` lists closest to the query.
+        The tolerance check is still exact on those candidates; only the choice
+        of candidates is approximate.
+
+        Until `train_size` entries have been inserted, the cache behaves like a
+        flat `ProximityCache`. The centroids are then trained with k-means on the
+        cached keys and every entry is indexed.
+
+        Evicted or overwritten entries are not removed from their list eagerly.
+        They are left as tombstones (their slot is now assigned to another list,
+        or is no longer valid) and are skipped at lookup. The lists are rebuilt
+        once they hold more than `compact_ratio` times the number of live entries.
+
+        Parameters
+        ----------
+        capacity: int
+            The maximum number of entries in the cache.
+
+        tolerance: float
+            The maximum euclidean distance between a query and a cached key for
+            the lookup to be a hit.
+
+        policy: str
+            The eviction policy, one of "fifo", "lru" or "lfu".
+
+        n_lists: int
+            The number of inverted lists (coarse centroids). Defaults to the
+            square root of the capacity.
+
+        n_probe: int
+            The number of lists visited per query.
+
+        train_size: int
+            The number of cached entries after which the centroids are trained.
+            Defaults to 8 * n_lists, capped at the capacity.
+
+        compact_ratio: float
+            Lists are rebuilt when the number of stored slots (live entries and
+            tombstones) exceeds this ratio times the number of live entries.
+
+        **kwargs: dict
+            Additional keyword arguments passed to `ProximityCache`.
+        """
+        super().__init__(capacity, tolerance, policy=policy, **kwargs)
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(capacity)))
+        if train_size is None:
+            train_size = min(capacity, 8 * n_lists)
+        if train_size < n_lists:
+            raise ValueError(f"train_size ({train_size}) must be at least n_lists ({n_lists}).")
+
+        self.n_lists = n_lists
+        self.n_probe = min(n_probe, n_lists)
+        self.train_size = train_size
+        self.compact_ratio = compact_ratio
+
+        # list of each slot, -1 if the slot is not indexed
+        self._assign = self._new_array("ivf_assign", (capacity,), np.int64, fill=-1)
+        self._centroids = None
+        self._lists = [np.empty(0, dtype=np.int64) for _ in range(n_lists)]
+        self._n_stored = 0
+
+    def _config(self):
+        config = super()._config()
+        config.update(
+            n_lists=self.n_lists,
+            n_probe=self.n_probe,
+            train_size=self.train_size,
+            compact_ratio=self.compact_ratio,
+        )
+        return config
+
+    def _restore(self):
+        super()._restore()
+        if "ivf_centroids" in self._preloaded:
+            shape = self._preloaded["ivf_centroids"].shape
+            self._centroids = self._new_array("ivf_centroids", shape, np.float32)
+            self._rebuild_lists()
+
+    @property
+    def is_trained(self):
+        return self._centroids is not None
+
+    def clear(self):
+        super().clear()
+        self._assign[:] = -1
+        self._lists = [np.empty(0, dtype=np.int64) for _ in range(self.n_lists)]
+        self._n_stored = 0
+
+    def train(self, samples=None, n_iter=10):
+        """
+        Train the coarse centroids and (re)index every cached entry.
+
+        Parameters
+        ----------
+        samples: numpy.ndarray
+            The vectors to train on, of shape (n_samples, dim). If None, the
+            currently cached keys are used.
+
+        n_iter: int
+            The number of k-means iterations.
+        """
+        if samples is None:
+            samples = self._decoded_keys(self._valid)
+        samples = self._as_matrix(samples)
+        if len(samples) < self.n_lists:
+            raise ValueError(
+                f"Need at least {self.n_lists} samples to train the cache index. Got {len(samples)}."
+            )
+
+        centroids = kmeans(samples, self.n_lists, n_iter=n_iter)
+        if "ivf_centroids" not in self._arrays:
+            self._centroids = self._new_array("ivf_centroids", centroids.shape, np.float32)
+        self._centroids[:] = centroids
+
+        slots = np.flatnonzero(self._valid)
+        self._assign[:] = -1
+        self._assign[slots] = self._closest_lists(self._decoded_keys(slots), 1)[:, 0]
+        self._rebuild_lists()
+
+    def _closest_lists(self, vectors, n):
+        """Returns the `n` closest centroids of each vector, shape (len(vectors), n)."""
+        sq_dist = -2.0 * vectors @ self._centroids.T
+        sq_dist += np.einsum("ij,ij->i", self._centroids, self._centroids)
+        if n >= self.n_lists:
+            return np.broadcast_to(np.arange(self.n_lists), (len(vectors), self.n_lists))
+        return np.argpartition(sq_dist, n - 1, axis=1)[:, :n]
+
+    def _rebuild_lists(self):
+        """Rebuild the inverted lists from `_assign`, dropping all tombstones."""
+        slots = np.flatnonzero(self._valid & (self._assign >= 0))
+        slots = slots[np.argsort(self._assign[slots], kind="stable")]
+        bounds = np.searchsorted(self._assign[slots], np.arange(1, self.n_lists))
+        self._lists = np.split(slots, bounds)
+        self._n_stored = len(slots)
+
+    def _write(self, slots, keys, values):
+        super()._write(slots, keys, values)
+        if not self.is_trained:
+            if len(self) >= self.train_size:
+                self.train()
+            return
+
+        # Overwritten slots become tombstones in their previous list.
+        lists = self._closest_lists(keys, 1)[:, 0]
+        self._assign[slots] = lists
+        order = np.argsort(lists, kind="stable")
+        touched, starts = np.unique(lists[order], return_index=True)
+        for list_id, group in zip(touched, np.split(slots[order], starts[1:])):
+            self._lists[list_id] = np.concatenate([self._lists[list_id], group])
+        self._n_stored += len(slots)
+
+        if self._n_stored > self.compact_ratio * max(len(self), self.n_lists):
+            self._rebuild_lists()
+
+    def _nearest(self, queries):
+        if not self.is_trained:
+            return super()._nearest(queries)
+
+        n = len(queries)
+        nearest = np.full(n, -1, dtype=np.int64)
+        distances = np.full(n, np.inf, dtype=np.float32)
+
+        probes = self._closest_lists(queries, self.n_probe)
+        best_sq_dist = np.full(n, np.inf, dtype=np.float32)
+        query_sq_norms = np.einsum("ij,ij->i", queries, queries)
+
+        # Group the (query, list) pairs by list so that each probed list is
+        # scanned once, against all the queries that probe it.
+        pair_lists = probes.ravel()
+        pair_queries = np.repeat(np.arange(n), probes.shape[1])
+        order = np.argsort(pair_lists, kind="stable")
+        probed, starts = np.unique(pair_lists[order], return_index=True)
+        for list_id, query_ids in zip(probed, np.split(pair_queries[order], starts[1:])):
+            slots = self._lists[list_id]
+            # skip tombstones (evicted slots, and slots re-assigned to another
+            # list) and entries of other versions
+            slots = slots[self._visible(slots) & (self._assign[slots] == list_id)]
+            if len(slots) == 0:
+                continue
+
+            sq_dist = -2.0 * queries[query_ids] @ self._decoded_keys(slots).T
+            sq_dist += self._sq_norms[slots]
+            sq_dist += query_sq_norms[query_ids, None]
+            best = np.argmin(sq_dist, axis=1)
+            candidate_sq_dist = sq_dist[np.arange(len(query_ids)), best]
+
+            better = candidate_sq_dist < best_sq_dist[query_ids]
+            best_sq_dist[query_ids[better]] = candidate_sq_dist[better]
+            nearest[query_ids[better]] = slots[best[better]]
+
+        found = nearest >= 0
+        distances[found] = np.sqrt(np.maximum(best_sq_dist[found], 0.0))
+        return nearest, distances
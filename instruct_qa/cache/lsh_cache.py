@@ -0,0 +1,238 @@
+import numpy as np
+
+from instruct_qa.cache.proximity_cache import ProximityCache
+
+
+class LSHProximityCache(ProximityCache):
+    def __init__(
+        self,
+        capacity,
+        tolerance,
+        policy="fifo",
+        n_tables=8,
+        n_hashes=4,
+        n_probe=4,
+        bucket_width=None,
+        seed=0,
+        compact_ratio=2.0,
+        **kwargs,
+    ):
+        """
+        Proximity cache whose keys are indexed by locality-sensitive hashing, so
+        that the cost of a lookup depends on the size of the probed buckets
+        rather than on the capacity. It uses p-stable (gaussian) LSH for the
+        euclidean distance: in each of `n_tables` tables, a key is hashed to the
+        bucket `floor((a . x + b) / bucket_width)` for `n_hashes` random
+        projections `a` and offsets `b`.
+
+        A lookup visits, in every table, the bucket of the query and `n_probe`
+        neighboring buckets (multi-probe): those obtained by moving one
+        projection by one bucket, towards the closest bucket boundaries. The
+        tolerance check is exact on the candidates of all the visited buckets;
+        only the choice of candidates is approximate.
+
+        As in `IVFProximityCache`, evicted entries are left in their buckets as
+        tombstones, skipped at lookup, and the tables are rebuilt once they hold
+        more than `compact_ratio` times the number of live entries.
+
+        Parameters
+        ----------
+        capacity: int
+            The maximum number of entries in the cache.
+
+        tolerance: float
+            The maximum euclidean distance between a query and a cached key for
+            the lookup to be a hit.
+
+        policy: str
+            The eviction policy, one of "fifo", "lru" or "lfu".
+
+        n_tables: int
+            The number of hash tables. More tables find more of the keys within
+            tolerance, at the cost of more candidates per lookup.
+
+        n_hashes: int
+            The number of projections per table. More projections make smaller
+            buckets.
+
+        n_probe: int
+            The number of neighboring buckets visited per table, in addition to
+            the bucket of the query.
+
+        bucket_width: float
+            The width of the buckets along each projection. Defaults to 4 times
+            the tolerance. It is fixed at construction, so later changes of the
+            tolerance only change the hit decisions, not the buckets.
+
+        seed: int
+            Seed of the random projections.
+
+        compact_ratio: float
+            Tables are rebuilt when the number of stored slots (live entries and
+            tombstones) exceeds this ratio times the number of live entries.
+
+        **kwargs: dict
+            Additional keyword arguments passed to `ProximityCache`.
+        """
+        super().__init__(capacity, tolerance, policy=policy, **kwargs)
+        if bucket_width is None:
+            bucket_width = 4.0 * tolerance
+        if bucket_width <= 0:
+            raise ValueError(f"bucket_width must be positive. Got {bucket_width}.")
+
+        self.n_tables = n_tables
+        self.n_hashes = n_hashes
+        self.n_probe = min(n_probe, 2 * n_hashes)
+        self.bucket_width = float(bucket_width)
+        self.seed = seed
+        self.compact_ratio = compact_ratio
+
+        # the projections depend on the dimension, and are drawn on first use
+        self._projections = None
+        self._offsets = None
+        rng = np.random.default_rng(seed)
+        # odd multipliers combining the n_hashes bucket coordinates into one key
+        self._multipliers = (
+            rng.integers(0, 2**62, size=(n_tables, n_hashes), dtype=np.int64) * 2 + 1
+        ).astype(np.uint64)
+
+        # bucket key of each slot in each table
+        self._codes = self._new_array("lsh_codes", (capacity, n_tables), np.int64)
+        self._tables = [{} for _ in range(n_tables)]
+        self._n_stored = 0
+
+    def _config(self):
+        config = super()._config()
+        config.update(
+            n_tables=self.n_tables,
+            n_hashes=self.n_hashes,
+            n_probe=self.n_probe,
+            bucket_width=self.bucket_width,
+            seed=self.seed,
+            compact_ratio=self.compact_ratio,
+        )
+        return config
+
+    def _restore(self):
+        super()._restore()
+        self._rebuild_tables()
+
+    def clear(self):
+        super().clear()
+        self._tables = [{} for _ in range(self.n_tables)]
+        self._n_stored = 0
+
+    def _project(self, vectors):
+        """
+        Returns the bucket coordinates of `vectors` along every projection, of
+        shape (n, n_tables, n_hashes), and their position within the bucket, in
+        [0, 1).
+        """
+        if self._projections is None:
+            rng = np.random.default_rng(self.seed + 1)
+            dim = vectors.shape[1]
+            self._projections = rng.standard_normal((self.n_tables * self.n_hashes, dim)).astype(np.float32)
+            self._offsets = rng.uniform(0, self.bucket_width, self.n_tables * self.n_hashes).astype(np.float32)
+
+        scaled = (vectors @ self._projections.T + self._offsets) / self.bucket_width
+        scaled = scaled.reshape(len(vectors), self.n_tables, self.n_hashes)
+        coordinates = np.floor(scaled)
+        return coordinates.astype(np.int64), scaled - coordinates
+
+    def _bucket_keys(self, coordinates):
+        """Combine bucket coordinates (..., n_tables, n_hashes) into keys (..., n_tables)."""
+        # unsigned arithmetic wraps around; colliding buckets only add candidates
+        keys = (coordinates.astype(np.uint64) * self._multipliers).sum(axis=-1)
+        return keys.astype(np.int64)
+
+    def _probe_keys(self, vectors):
+        """
+        Returns the keys of the buckets visited for each vector, of shape
+        (n, n_tables, 1 + n_probe): the bucket of the vector first, then the
+        neighbors across the `n_probe` closest bucket boundaries.
+        """
+        coordinates, position = self._project(vectors)
+        keys = self._bucket_keys(coordinates)
+        if self.n_probe == 0:
+            return keys[:, :, None]
+
+        # distance to the lower boundary (moving by -1) and to the upper one (+1)
+        costs = np.concatenate([position, 1.0 - position], axis=2)
+        closest = np.argpartition(costs, self.n_probe - 1, axis=2)[:, :, :self.n_probe]
+        steps = np.where(closest < self.n_hashes, -1, 1).astype(np.int64)
+        multipliers = np.take_along_axis(
+            np.broadcast_to(self._multipliers, (len(vectors), self.n_tables, self.n_hashes)),
+            closest % self.n_hashes,
+            axis=2,
+        )
+        # the key is linear in the coordinates, so a step shifts it by a multiplier
+        neighbors = keys[:, :, None].astype(np.uint64) + steps.astype(np.uint64) * multipliers
+        return np.concatenate([keys[:, :, None], neighbors.astype(np.int64)], axis=2)
+
+    def _rebuild_tables(self):
+        """Rebuild the hash tables from `_codes`, dropping all tombstones."""
+        slots = np.flatnonzero(self._valid)
+        self._tables = [self._group(self._codes[slots, table], slots) for table in range(self.n_tables)]
+        self._n_stored = len(slots)
+
+    @staticmethod
+    def _group(keys, slots):
+        """Returns a dict from each distinct key to the array of its slots."""
+        order = np.argsort(keys, kind="stable")
+        unique, starts = np.unique(keys[order], return_index=True)
+        return dict(zip(unique.tolist(), np.split(slots[order], starts[1:])))
+
+    def _write(self, slots, keys, values):
+        super()._write(slots, keys, values)
+        codes = self._bucket_keys(self._project(keys)[0])
+        self._codes[slots] = codes
+        # Overwritten slots become tombstones in their previous buckets.
+        for table, buckets in enumerate(self._tables):
+            for key, group in self._group(codes[:, table], slots).items():
+                bucket = buckets.get(key)
+                buckets[key] = group if bucket is None else np.concatenate([bucket, group])
+        self._n_stored += len(slots)
+
+        if self._n_stored > self.compact_ratio * max(len(self), 1):
+            self._rebuild_tables()
+
+    def _nearest(self, queries):
+        n = len(queries)
+        nearest = np.full(n, -1, dtype=np.int64)
+        distances = np.full(n, np.inf, dtype=np.float32)
+        if self._keys is None or len(self) == 0:
+            return nearest, distances
+
+        probes = self._probe_keys(queries)
+        candidates = []
+        lengths = np.zeros(n, dtype=np.int64)
+        for i in range(n):
+            for table, buckets in enumerate(self._tables):
+                for key in probes[i, table].tolist():
+                    bucket = buckets.get(key)
+                    if bucket is not None:
+                        candidates.append(bucket)
+                        lengths[i] += len(bucket)
+        if not candidates:
+            return nearest, distances
+
+        query_ids = np.repeat(np.arange(n), lengths)
+        slots = np.concatenate(candidates)
+        # skip tombstones and entries of other versions, and visit each candidate once per query
+        live = self._visible(slots)
+        pairs = np.unique(query_ids[live] * self.capacity + slots[live])
+        query_ids, slots = pairs // self.capacity, pairs % self.capacity
+        if len(slots) == 0:
+            return nearest, distances
+
+        keys = self._decoded_keys(slots)
+        sq_dist = np.einsum("ij,ij->i", queries[query_ids], queries[query_ids])
+        sq_dist -= 2.0 * np.einsum("ij,ij->i", queries[query_ids], keys)
+        sq_dist += self._sq_norms[slots]
+
+        # closest candidate of each query: sort by query, then by distance
+        order = np.lexsort((sq_dist, query_ids))
+        first = order[np.unique(query_ids[order], return_index=True)[1]]
+        nearest[query_ids[first]] = slots[first]
+        distances[query_ids[first]] = np.sqrt(np.maximum(sq_dist[first], 0.0))
+        return nearest, distances
@@ -0,0 +1,795 @@
+import abc
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+from instruct_qa.cache.admission import ADMISSION_NAME_TO_CLASS
+
+
+class EvictionPolicy(metaclass=abc.ABCMeta):
+    """
+    Bookkeeping used by a proximity cache to decide which slots to overwrite
+    once it is full. All the state is kept in NumPy arrays indexed by slot, so
+    that a whole batch of hits or insertions is a single vectorized update.
+
+    Parameters
+    ----------
+    capacity: int
+        The number of slots of the cache.
+
+    new_array: callable
+        Function with signature `new_array(name, shape, dtype)` returning a
+        zero-initialized array. The cache passes its own allocator so that the
+        policy metadata lives next to the keys and values.
+    """
+
+    name = None
+
+    def __init__(self, capacity, new_array):
+        self.capacity = capacity
+
+    @abc.abstractmethod
+    def on_insert(self, slots, ticks):
+        """
+        Called after new entries have been written to `slots`. `ticks` holds the
+        logical time of each insertion.
+        """
+        pass
+
+    @abc.abstractmethod
+    def on_hit(self, slots, ticks):
+        """
+        Called after lookups were answered from `slots`. A slot may appear
+        several times if several queries of a batch hit the same entry.
+        """
+        pass
+
+    @abc.abstractmethod
+    def priority(self):
+        """
+        Returns
+        -------
+        numpy.ndarray
+            Array of shape (capacity,). Slots with the lowest priority are
+            evicted first.
+        """
+        pass
+
+    def victims(self, n, valid):
+        """
+        Select `n` occupied slots to evict.
+
+        Parameters
+        ----------
+        n: int
+            Number of slots to free. Must not exceed the number of occupied slots.
+
+        valid: numpy.ndarray
+            Boolean mask of the occupied slots.
+
+        Returns
+        -------
+        numpy.ndarray
+            The slots to evict, of shape (n,).
+        """
+        slots = np.flatnonzero(valid)
+        if n >= len(slots):
+            return slots
+        priority = self.priority()[slots]
+        return slots[np.argpartition(priority, n - 1)[:n]]
+
+
+class FifoPolicy(EvictionPolicy):
+    """Evicts the entries that were inserted first."""
+
+    name = "fifo"
+
+    def __init__(self, capacity, new_array):
+        super().__init__(capacity, new_array)
+        self.inserted = new_array("policy_inserted", (capacity,), np.int64)
+
+    def on_insert(self, slots, ticks):
+        self.inserted[slots] = ticks
+
+    def on_hit(self, slots, ticks):
+        pass
+
+    def priority(self):
+        return self.inserted
+
+
+class LruPolicy(EvictionPolicy):
+    """Evicts the entries that were used (inserted or hit) least recently."""
+
+    name = "lru"
+
+    def __init__(self, capacity, new_array):
+        super().__init__(capacity, new_array)
+        self.last_used = new_array("policy_last_used", (capacity,), np.int64)
+
+    def on_insert(self, slots, ticks):
+        self.last_used[slots] = ticks
+
+    def on_hit(self, slots, ticks):
+        # Ticks are increasing, so with repeated slots the last write wins,
+        # which is the most recent use.
+        self.last_used[slots] = ticks
+
+    def priority(self):
+        return self.last_used
+
+
+class LfuPolicy(EvictionPolicy):
+    """
+    Evicts the entries with the fewest hits. Ties are broken by evicting the
+    oldest entry first.
+    """
+
+    name = "lfu"
+
+    def __init__(self, capacity, new_array):
+        super().__init__(capacity, new_array)
+        self.counts = new_array("policy_counts", (capacity,), np.int64)
+        self.inserted = new_array("policy_inserted", (capacity,), np.int64)
+
+    def on_insert(self, slots, ticks):
+        self.counts[slots] = 0
+        self.inserted[slots] = ticks
+
+    def on_hit(self, slots, ticks):
+        np.add.at(self.counts, slots, 1)
+
+    def priority(self):
+        return self.counts
+
+    def victims(self, n, valid):
+        slots = np.flatnonzero(valid)
+        if n >= len(slots):
+            return slots
+        order = np.lexsort((self.inserted[slots], self.counts[slots]))
+        return slots[order[:n]]
+
+
+POLICY_NAME_TO_CLASS = {
+    policy.name: policy for policy in [FifoPolicy, LruPolicy, LfuPolicy]
+}
+
+
+KEY_DTYPES = ["float32", "float16", "int8"]
+
+
+class ProximityCache:
+    default_policy = "fifo"
+    # number of quantized keys up-cast to float32 at a time when computing distances
+    block_size = 4096
+
+    def __init__(
+        self,
+        capacity,
+        tolerance,
+        policy=None,
+        dim=None,
+        value_size=None,
+        key_dtype="float32",
+        strict_tolerance=False,
+        admission=None,
+        ttl=None,
+    ):
+        """
+        Approximate key-value cache over embeddings. A lookup is a hit if a
+        cached key lies within `tolerance` (euclidean distance) of the query, in
+        which case the value of the closest key is returned.
+
+        Keys are stored in a single contiguous float32 matrix and values (e.g.
+        the indices of retrieved passages) in a parallel int64 matrix, so that a
+        lookup is one vectorized distance computation against every cached key.
+
+        Parameters
+        ----------
+        capacity: int
+            The maximum number of entries in the cache.
+
+        tolerance: float
+            The maximum euclidean distance between a query and a cached key for
+            the lookup to be a hit.
+
+        policy: str
+            The eviction policy, one of "fifo", "lru" or "lfu". Defaults to the
+            `default_policy` of the class.
+
+        dim: int
+            The dimension of the keys. If None, it is inferred on the first insertion.
+
+        value_size: int
+            The number of integers stored per entry. If None, it is inferred on
+            the first insertion.
+
+        key_dtype: str
+            The storage type of the keys: "float32", "float16" (half the memory)
+            or "int8" with a float32 scale per key (about a quarter). Distances
+            are computed against the dequantized keys, in blocks of `block_size`
+            keys, and the quantization error of every key is stored.
+
+        strict_tolerance: bool
+            Only used with quantized keys. If False, a lookup is a hit if the
+            dequantized key is within tolerance, so hit decisions can differ
+            from float32 keys for queries whose distance is within the
+            quantization error of the tolerance. If True, the quantization error
+            of the key is added to the distance, so that every hit is also a hit
+            with float32 keys (by the triangle inequality), at the cost of a few
+            misses near the tolerance.
+
+        admission: str
+            The admission filter applied when new entries would evict existing
+            ones: None (always admit) or "tinylfu", which only admits entries
+            whose region of the embedding space is looked up more often than
+            the one of the evicted entry. See `TinyLfuAdmission`.
+
+        ttl: float
+            If not None, entries expire `ttl` seconds (wall-clock) after their
+            insertion, and expired entries are dropped before each lookup and
+            insertion.
+
+        Entries are also tagged with the `version` of the cache at insertion,
+        see `set_version`.
+        """
+        if capacity <= 0:
+            raise ValueError(f"capacity must be positive. Got {capacity}.")
+        if policy is None:
+            policy = self.default_policy
+        if policy not in POLICY_NAME_TO_CLASS:
+            raise ValueError(
+                f"Unknown eviction policy {policy}. Use one of {list(POLICY_NAME_TO_CLASS)}."
+            )
+
+        if admission is not None and admission not in ADMISSION_NAME_TO_CLASS:
+            raise ValueError(
+                f"Unknown admission filter {admission}. Use one of {list(ADMISSION_NAME_TO_CLASS)}."
+            )
+        if key_dtype not in KEY_DTYPES:
+            raise ValueError(f"Unknown key dtype {key_dtype}. Use one of {KEY_DTYPES}.")
+
+        self.capacity = capacity
+        self.tolerance = tolerance
+        self.policy_name = policy
+        self.key_dtype = key_dtype
+        self.strict_tolerance = strict_tolerance
+        self.admission = admission
+        self.ttl = ttl
+        self._arrays = {}
+        # arrays read from a snapshot by `load`, consumed by `_new_array`
+        self._preloaded = getattr(self, "_preloaded", {})
+
+        self._valid = self._new_array("valid", (capacity,), np.bool_)
+        # [logical clock, high-water mark of the used slots, number of evictions, version]
+        self._counters = self._new_array("counters", (4,), np.int64)
+        self._versions = self._new_array("versions", (capacity,), np.int64)
+        self._inserted_at = None
+        if ttl is not None:
+            self._inserted_at = self._new_array("inserted_at", (capacity,), np.float64)
+        self.version = int(self._counters[3])
+        self._policy = POLICY_NAME_TO_CLASS[policy](capacity, self._new_array)
+        self._admission = None
+        if admission is not None:
+            self._admission = ADMISSION_NAME_TO_CLASS[admission](capacity, self._new_array)
+
+        self._keys = None
+        self._key_scales = None
+        self._key_errors = None
+        self._sq_norms = None
+        self._values = None
+        if dim is not None and value_size is not None:
+            self._allocate(dim, value_size)
+
+    def _new_array(self, name, shape, dtype, fill=0):
+        if name in self._preloaded:
+            array = self._preloaded.pop(name)
+            if array.shape != tuple(shape) or array.dtype != dtype:
+                raise ValueError(
+                    f"Snapshot array {name} has shape {array.shape} and dtype {array.dtype}, "
+                    f"expected {tuple(shape)} and {np.dtype(dtype)}."
+                )
+        else:
+            array = np.full(shape, fill, dtype=dtype)
+        self._arrays[name] = array
+        return array
+
+    def _config(self):
+        """The constructor arguments needed to re-create this cache."""
+        return {
+            "capacity": self.capacity,
+            "tolerance": self.tolerance,
+            "policy": self.policy_name,
+            "dim": self.dim,
+            "value_size": self.value_size,
+            "key_dtype": self.key_dtype,
+            "strict_tolerance": self.strict_tolerance,
+            "admission": self.admission,
+            "ttl": self.ttl,
+        }
+
+    def save(self, path):
+        """
+        Save a snapshot of the cache to a directory: one .npy file per array
+        (keys, values, policy metadata, ...) and a meta.json file with the
+        constructor arguments.
+
+        Files are written next to their destination and then renamed, so it is
+        safe to save to the directory the cache was memory-mapped from.
+
+        Parameters
+        ----------
+        path: str
+            The directory to save the snapshot to. It is created if needed.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name, array in self._arrays.items():
+            with open(path / f"{name}.npy.tmp", "wb") as f:
+                np.save(f, array)
+            os.replace(path / f"{name}.npy.tmp", path / f"{name}.npy")
+
+        meta = {
+            "cache_class": type(self).__name__,
+            "config": self._config(),
+            "arrays": list(self._arrays),
+        }
+        with open(path / "meta.json.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path / "meta.json.tmp", path / "meta.json")
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a snapshot saved with `save`.
+
+        Parameters
+        ----------
+        path: str
+            The directory the snapshot was saved to.
+
+        mmap: bool
+            If True, the arrays are memory-mapped copy-on-write instead of read:
+            loading is immediate and pages are only read when accessed. Changes
+            to the cache are never written back to the snapshot.
+
+        Returns
+        -------
+        ProximityCache
+            The restored cache, of the same class as the saved one.
+        """
+        path = Path(path)
+        with open(path / "meta.json") as f:
+            meta = json.load(f)
+        if meta["cache_class"] != cls.__name__:
+            raise ValueError(
+                f"Snapshot at {path} is a {meta['cache_class']}, cannot load it as a {cls.__name__}."
+            )
+
+        cache = cls.__new__(cls)
+        cache._preloaded = {
+            name: np.load(path / f"{name}.npy", mmap_mode="c" if mmap else None)
+            for name in meta["arrays"]
+        }
+        cache.__init__(**meta["config"])
+        cache._restore()
+        if cache._preloaded:
+            raise ValueError(f"Unexpected arrays in snapshot: {list(cache._preloaded)}.")
+        return cache
+
+    def _restore(self):
+        """
+        Called by `load` after the constructor, to rebuild any state derived
+        from the preloaded arrays.
+        """
+        pass
+
+    # configuration that may differ between a snapshot and the cache it is restored into
+    _runtime_config = ("tolerance",)
+
+    def check_snapshot(self, path):
+        """
+        Check that a snapshot saved with `save` has the class and configuration
+        of this cache, apart from the tolerance and, if not known yet, the
+        dimensions.
+
+        Parameters
+        ----------
+        path: str
+            The directory the snapshot was saved to.
+
+        Returns
+        -------
+        dict
+            The metadata of the snapshot.
+        """
+        path = Path(path)
+        with open(path / "meta.json") as f:
+            meta = json.load(f)
+        if meta["cache_class"] != type(self).__name__:
+            raise ValueError(
+                f"Snapshot at {path} is a {meta['cache_class']}, but the cache is a {type(self).__name__}."
+            )
+        config = self._config()
+        mismatched = {
+            key: (value, config.get(key))
+            for key, value in meta["config"].items()
+            if key not in self._runtime_config and value != config.get(key)
+            # dim and value_size may not be inferred yet
+            and not (key in ("dim", "value_size") and config.get(key) is None)
+        }
+        if mismatched:
+            raise ValueError(
+                f"Snapshot at {path} does not match the cache configuration, "
+                f"(snapshot, cache) values: {mismatched}."
+            )
+        return meta
+
+    def _allocate(self, dim, value_size):
+        self._keys = self._new_array("keys", (self.capacity, dim), self.key_dtype)
+        if self.key_dtype == "int8":
+            self._key_scales = self._new_array("key_scales", (self.capacity,), np.float32)
+        if self.key_dtype != "float32":
+            self._key_errors = self._new_array("key_errors", (self.capacity,), np.float32)
+        self._sq_norms = self._new_array("sq_norms", (self.capacity,), np.float32)
+        self._values = self._new_array("values", (self.capacity, value_size), np.int64)
+
+    @property
+    def dim(self):
+        return None if self._keys is None else self._keys.shape[1]
+
+    @property
+    def value_size(self):
+        return None if self._values is None else self._values.shape[1]
+
+    def __len__(self):
+        return int(np.count_nonzero(self._valid))
+
+    def values(self):
+        """The values of the cached entries, of shape (len(self), value_size)."""
+        if self._values is None:
+            return np.empty((0, 0), dtype=np.int64)
+        return self._values[self._valid]
+
+    @property
+    def admitted(self):
+        """The number of entries admitted by the admission filter (0 without one)."""
+        return 0 if self._admission is None else self._admission.admitted
+
+    @property
+    def rejected(self):
+        """The number of entries rejected by the admission filter (0 without one)."""
+        return 0 if self._admission is None else self._admission.rejected
+
+    @property
+    def nbytes(self):
+        """The memory used by the cache arrays, in bytes."""
+        return sum(array.nbytes for array in self._arrays.values())
+
+    def quantization_error(self):
+        """
+        Returns
+        -------
+        dict
+            The mean, 99th percentile and maximum euclidean distance between the
+            cached keys and their float32 value, and the same statistics
+            relative to the norm of the keys. All zero for float32 keys.
+        """
+        stats = {}
+        if self._key_errors is None or len(self) == 0:
+            errors = relative = np.zeros(1, dtype=np.float32)
+        else:
+            errors = self._key_errors[self._valid]
+            relative = errors / np.maximum(np.sqrt(self._sq_norms[self._valid]), 1e-12)
+        for prefix, values in [("", errors), ("relative_", relative)]:
+            stats[f"{prefix}mean"] = float(values.mean())
+            stats[f"{prefix}p99"] = float(np.percentile(values, 99))
+            stats[f"{prefix}max"] = float(values.max())
+        return stats
+
+    @property
+    def evictions(self):
+        """The number of valid entries overwritten since the cache was created."""
+        return int(self._counters[2])
+
+    def clear(self):
+        self._valid[:] = False
+        self._counters[1] = 0
+
+    @property
+    def latest_version(self):
+        """
+        The version most recently set on the cache. It differs from `version`
+        when the cache is shared with other processes and one of them changed
+        the version.
+        """
+        return int(self._counters[3])
+
+    def set_version(self, version):
+        """
+        Set the version that new entries are tagged with, e.g. the fingerprint
+        of the index their values point into, and invalidate every entry tagged
+        with another version. Lookups only return entries of the current version.
+
+        Parameters
+        ----------
+        version: int
+            The new version, a 64-bit integer.
+
+        Returns
+        -------
+        int
+            The number of entries invalidated.
+        """
+        self.version = int(version)
+        self._counters[3] = self.version
+        stale = self._valid & (self._versions != self.version)
+        self._valid[stale] = False
+        return int(np.count_nonzero(stale))
+
+    def expire(self):
+        """
+        Invalidate the entries older than `ttl` seconds.
+
+        Returns
+        -------
+        int
+            The number of entries invalidated.
+        """
+        return self._expire()
+
+    def _expire(self):
+        if self.ttl is None:
+            return 0
+        expired = self._valid & (self._inserted_at < time.time() - self.ttl)
+        n_expired = int(np.count_nonzero(expired))
+        if n_expired > 0:
+            self._valid[expired] = False
+        return n_expired
+
+    def _tick(self, n):
+        start = int(self._counters[0])
+        self._counters[0] = start + n
+        return np.arange(start, start + n, dtype=np.int64)
+
+    @staticmethod
+    def _as_matrix(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors.reshape(1, -1)
+        return np.ascontiguousarray(vectors)
+
+    def _encode_keys(self, keys):
+        """
+        Quantize float32 keys to `key_dtype`. Returns the stored keys, their
+        scales (None unless int8) and the dequantized keys.
+        """
+        if self.key_dtype == "float32":
+            return keys, None, keys
+        if self.key_dtype == "float16":
+            encoded = keys.astype(np.float16)
+            return encoded, None, encoded.astype(np.float32)
+        scales = np.abs(keys).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        encoded = np.rint(keys / scales[:, None]).astype(np.int8)
+        return encoded, scales, encoded.astype(np.float32) * scales[:, None]
+
+    def _decoded_keys(self, slots):
+        """The keys at `slots` (indices or a slice) as float32."""
+        if self.key_dtype == "float32":
+            return self._keys[slots]
+        keys = self._keys[slots].astype(np.float32)
+        if self._key_scales is not None:
+            keys *= self._key_scales[slots][:, None]
+        return keys
+
+    def _sq_distances(self, queries, high):
+        """
+        Squared euclidean distances between `queries` and the first `high`
+        slots, with unoccupied slots set to infinity. Shape (n_queries, high).
+        """
+        if self.key_dtype == "float32":
+            sq_dist = queries @ self._keys[:high].T
+        else:
+            # up-cast the quantized keys block by block to bound the temporary memory
+            sq_dist = np.empty((len(queries), high), dtype=np.float32)
+            for start in range(0, high, self.block_size):
+                stop = min(start + self.block_size, high)
+                sq_dist[:, start:stop] = queries @ self._decoded_keys(slice(start, stop)).T
+        sq_dist *= -2.0
+        sq_dist += self._sq_norms[:high]
+        sq_dist += np.einsum("ij,ij->i", queries, queries)[:, None]
+        np.maximum(sq_dist, 0.0, out=sq_dist)
+        sq_dist[:, ~self._visible(slice(0, high))] = np.inf
+        return sq_dist
+
+    def _visible(self, slots):
+        """Mask of the `slots` holding a valid entry of the current version."""
+        return self._valid[slots] & (self._versions[slots] == self.version)
+
+    def _nearest(self, queries):
+        """
+        Returns the closest slot holding an entry of the current version for
+        each query, and its distance. The slot is -1 (and the distance
+        infinite) when there is none.
+        """
+        n = len(queries)
+        high = int(self._counters[1])
+        if self._keys is None or high == 0:
+            return np.full(n, -1, dtype=np.int64), np.full(n, np.inf, dtype=np.float32)
+
+        sq_dist = self._sq_distances(queries, high)
+        nearest = np.argmin(sq_dist, axis=1)
+        distances = np.sqrt(sq_dist[np.arange(n), nearest])
+        nearest[np.isinf(distances)] = -1
+        return nearest, distances
+
+    def find(self, key):
+        """
+        Look up a single key.
+
+        Parameters
+        ----------
+        key: numpy.ndarray or list of floats
+            The query embedding, of shape (dim,).
+
+        Returns
+        -------
+        numpy.ndarray or None
+            The value of the closest cached key if it is within tolerance, None otherwise.
+        """
+        hit_mask, values, _ = self.find_batch(self._as_matrix(key))
+        return values[0] if hit_mask[0] else None
+
+    def insert(self, key, value):
+        """
+        Insert a single entry, evicting another one if the cache is full.
+
+        Parameters
+        ----------
+        key: numpy.ndarray or list of floats
+            The embedding, of shape (dim,).
+
+        value: numpy.ndarray or list of ints
+            The value to store, of shape (value_size,).
+        """
+        self.insert_batch(self._as_matrix(key), np.asarray(value).reshape(1, -1))
+
+    def find_batch(self, queries):
+        """
+        Look up a batch of keys with a single (n_queries, capacity) distance computation.
+
+        Parameters
+        ----------
+        queries: numpy.ndarray
+            The query embeddings, of shape (n_queries, dim).
+
+        Returns
+        -------
+        hit_mask: numpy.ndarray
+            Boolean array of shape (n_queries,), True where a cached key is within tolerance.
+
+        values: numpy.ndarray
+            Array of shape (n_queries, value_size) with the value of the closest
+            cached key for hits, and -1 for misses. If the cache has never been
+            written to, value_size is 0.
+
+        distances: numpy.ndarray
+            Array of shape (n_queries,) with the distance to the closest cached
+            key (infinite if the cache is empty), for hits and misses alike.
+        """
+        queries = self._as_matrix(queries)
+        self.expire()
+        hit_mask, values, distances, hit_slots = self._lookup(queries)
+        if self._admission is not None and len(queries) > 0:
+            self._admission.record(queries)
+        if len(hit_slots) > 0:
+            self._policy.on_hit(hit_slots, self._tick(len(hit_slots)))
+        return hit_mask, values, distances
+
+    def _lookup(self, queries):
+        """
+        The read-only part of `find_batch`. Also returns the slots that were hit,
+        for the eviction policy.
+        """
+        nearest, distances = self._nearest(queries)
+        if self.strict_tolerance and self._key_errors is not None:
+            hit_mask = distances + self._key_errors[nearest] <= self.tolerance
+        else:
+            hit_mask = distances <= self.tolerance
+        # entries written by a process that uses another version
+        hit_mask &= self._versions[nearest] == self.version
+
+        values = np.full((len(queries), self.value_size or 0), -1, dtype=np.int64)
+        hit_slots = nearest[hit_mask]
+        if len(hit_slots) > 0:
+            values[hit_mask] = self._values[hit_slots]
+        return hit_mask, values, distances, hit_slots
+
+    def insert_batch(self, keys, values):
+        """
+        Insert a batch of entries, evicting as many entries as needed. If the
+        batch is larger than the capacity, only its last `capacity` entries are
+        kept. With an admission filter, entries that would evict a more
+        frequently used entry are dropped.
+
+        Parameters
+        ----------
+        keys: numpy.ndarray
+            The embeddings, of shape (n, dim).
+
+        values: numpy.ndarray
+            The values to store, of shape (n, value_size).
+        """
+        keys = self._as_matrix(keys)
+        if len(keys) == 0:
+            return
+        values = np.asarray(values, dtype=np.int64).reshape(len(keys), -1)
+        if len(keys) > self.capacity:
+            keys, values = keys[-self.capacity:], values[-self.capacity:]
+        if self._keys is None:
+            self._allocate(keys.shape[1], values.shape[1])
+        if (keys.shape[1], values.shape[1]) != (self.dim, self.value_size):
+            raise ValueError(
+                f"Expected keys of dimension {self.dim} and values of size {self.value_size}. "
+                f"Got {keys.shape[1]} and {values.shape[1]}."
+            )
+
+        self._expire()
+        slots = self._acquire_slots(len(keys))
+        if self._admission is not None:
+            admitted = self._admission.admit(keys, slots, self._valid)
+            slots, keys, values = slots[admitted], keys[admitted], values[admitted]
+            if len(slots) == 0:
+                return
+        self._counters[2] += np.count_nonzero(self._valid[slots])
+        self._write(slots, keys, values)
+
+    def _acquire_slots(self, n):
+        """
+        Returns `n` slots to write to. Free slots are used first, then
+        occupied slots are chosen by the eviction policy.
+        """
+        free = np.flatnonzero(~self._valid)[:n]
+        if len(free) == n:
+            return free
+        victims = self._policy.victims(n - len(free), self._valid)
+        return np.concatenate([free, victims])
+
+    def _write(self, slots, keys, values):
+        encoded, scales, decoded = self._encode_keys(keys)
+        self._keys[slots] = encoded
+        if scales is not None:
+            self._key_scales[slots] = scales
+        if self._key_errors is not None:
+            self._key_errors[slots] = np.linalg.norm(keys - decoded, axis=1)
+        # norms of the dequantized keys, so that distances are exact with respect to them
+        self._sq_norms[slots] = np.einsum("ij,ij->i", decoded, decoded)
+        self._values[slots] = values
+        self._versions[slots] = self.version
+        if self._inserted_at is not None:
+            self._inserted_at[slots] = time.time()
+        self._valid[slots] = True
+        self._counters[1] = max(int(self._counters[1]), int(slots.max()) + 1)
+        self._policy.on_insert(slots, self._tick(len(slots)))
+
+
+class FifoCache(ProximityCache):
+    """Proximity cache evicting the entries that were inserted first."""
+
+    default_policy = "fifo"
+
+
+class LruCache(ProximityCache):
+    """Proximity cache evicting the least recently used entries."""
+
+    default_policy = "lru"
+
+
+class LfuCache(ProximityCache):
+    """Proximity cache evicting the least frequently hit entries."""
+
+    default_policy = "lfu"
@@ -0,0 +1,517 @@
+"""
+Standalone TCP server exposing a proximity cache to runners on other machines,
+and `RemoteProximityCache`, a client with the interface `ResponseRunner` uses.
+
+Every message is a fixed-size header followed by a binary payload. Requests
+have the header `REQUEST` (op, n, dim, value_size, param, version) and
+responses the header `RESPONSE` (status, payload length). Embeddings are sent as raw
+little-endian float32 and values as int64, so a batch is copied straight into
+and out of NumPy arrays. Responses are sent in request order on each
+connection, which lets the client pipeline requests.
+
+Clients may use different index versions, e.g. during the rollout of a new
+index: each request carries the version of its client, lookups only return
+entries inserted with that version, and insertions are tagged with it.
+
+Start a server with, e.g.::
+
+    python -m instruct_qa.cache.server --cache lru --capacity 100000 --tolerance 0.5 --port 7007
+"""
+import argparse
+import json
+import queue
+import socket
+import socketserver
+import struct
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+REQUEST = struct.Struct("<BIIIdq")
+RESPONSE = struct.Struct("<BQ")
+
+OP_FIND = 1
+OP_INSERT = 2
+OP_INFO = 3
+OP_CLEAR = 4
+OP_SAVE = 6
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+
+def _recv_exact(sock, n):
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    received = 0
+    while received < n:
+        size = sock.recv_into(view[received:], n - received)
+        if size == 0:
+            raise ConnectionError("Connection closed by the peer.")
+        received += size
+    return buffer
+
+
+class _CacheRequestHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        while True:
+            try:
+                header = _recv_exact(self.request, REQUEST.size)
+            except ConnectionError:
+                return
+            op, n, dim, value_size, param, version = REQUEST.unpack(header)
+            try:
+                payload = self.server.handle_request_payload(
+                    self.request, op, n, dim, value_size, param, version
+                )
+                status = STATUS_OK
+            except Exception as e:
+                payload = f"{type(e).__name__}: {e}".encode()
+                status = STATUS_ERROR
+            self.request.sendall(RESPONSE.pack(status, len(payload)) + payload)
+
+
+class CacheServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, cache, host="127.0.0.1", port=0, snapshot_path=None):
+        """
+        TCP server answering batch lookups and insertions on a proximity cache.
+        Each connection is served by its own thread, and operations on the cache
+        are serialized by a lock.
+
+        The server has no authentication: only expose it on trusted networks.
+        Clients cannot choose where it writes; snapshots only go to
+        `snapshot_path`.
+
+        Parameters
+        ----------
+        cache: ProximityCache
+            The cache to serve.
+
+        host: str
+            The address to listen on.
+
+        port: int
+            The port to listen on. If 0, a free port is picked, see `address`.
+
+        snapshot_path: str
+            The directory snapshots are saved to on request of a client. If
+            None, save requests are refused.
+        """
+        super().__init__((host, port), _CacheRequestHandler)
+        self.cache = cache
+        self.snapshot_path = snapshot_path
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def address(self):
+        """The (host, port) the server listens on."""
+        return self.server_address[:2]
+
+    def start(self):
+        """Serve in a background daemon thread, e.g. for tests on localhost."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @contextmanager
+    def _client_settings(self, version, tolerance=None):
+        """
+        Use the version (and tolerance) of a client for the operations run in
+        the context. Must be entered with the lock held.
+        """
+        previous = self.cache.version, self.cache.tolerance
+        self.cache.version = version
+        if tolerance is not None:
+            self.cache.tolerance = tolerance
+        try:
+            yield
+        finally:
+            self.cache.version, self.cache.tolerance = previous
+
+    def handle_request_payload(self, sock, op, n, dim, value_size, param, version):
+        """Read the payload of a request from `sock`, run it and return the response payload."""
+        if op == OP_FIND:
+            queries = np.frombuffer(_recv_exact(sock, 4 * n * dim), dtype="<f4").reshape(n, dim)
+            # the tolerance and the version are chosen by each client
+            with self._lock, self._client_settings(version, tolerance=param):
+                hit_mask, values, distances = self.cache.find_batch(queries)
+            return (
+                struct.pack("<I", values.shape[1])
+                + hit_mask.astype(np.uint8).tobytes()
+                + values.astype("<i8").tobytes()
+                + distances.astype("<f4").tobytes()
+            )
+        if op == OP_INSERT:
+            keys = np.frombuffer(_recv_exact(sock, 4 * n * dim), dtype="<f4").reshape(n, dim)
+            values = np.frombuffer(_recv_exact(sock, 8 * n * value_size), dtype="<i8").reshape(n, value_size)
+            with self._lock, self._client_settings(version):
+                counts = (self.cache.evictions, self.cache.admitted, self.cache.rejected)
+                self.cache.insert_batch(keys, values)
+                # the counts caused by this insertion, so that clients need no extra round trip
+                deltas = (
+                    self.cache.evictions - counts[0],
+                    self.cache.admitted - counts[1],
+                    self.cache.rejected - counts[2],
+                )
+            return struct.pack("<qqq", *deltas)
+        if op == OP_INFO:
+            with self._lock:
+                info = {
+                    "capacity": self.cache.capacity,
+                    "tolerance": self.cache.tolerance,
+                    "dim": self.cache.dim,
+                    "value_size": self.cache.value_size,
+                    "len": len(self.cache),
+                    "ttl": self.cache.ttl,
+                    "evictions": self.cache.evictions,
+                    "admitted": self.cache.admitted,
+                    "rejected": self.cache.rejected,
+                }
+            return json.dumps(info).encode()
+        if op == OP_CLEAR:
+            with self._lock:
+                self.cache.clear()
+            return b""
+        if op == OP_SAVE:
+            if self.snapshot_path is None:
+                raise ValueError("The server has no snapshot directory, start it with --snapshot.")
+            with self._lock:
+                self.cache.save(self.snapshot_path)
+            return b""
+        raise ValueError(f"Unknown operation {op}.")
+
+
+class _Connection:
+    def __init__(self, address, timeout):
+        self.socket = socket.create_connection(address, timeout=timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # requests sent whose (empty) response has not been read yet
+        self.pending = 0
+
+    def send(self, op, n=0, dim=0, value_size=0, param=0.0, version=0, *payloads):
+        self.socket.sendall(REQUEST.pack(op, n, dim, value_size, param, version))
+        for payload in payloads:
+            self.socket.sendall(payload)
+
+    def receive(self):
+        status, length = RESPONSE.unpack(_recv_exact(self.socket, RESPONSE.size))
+        payload = _recv_exact(self.socket, length)
+        if status != STATUS_OK:
+            raise RuntimeError(f"Cache server error: {payload.decode()}")
+        return payload
+
+    def drain(self):
+        """Read the responses of the pipelined requests sent earlier, and return them."""
+        payloads = []
+        while self.pending > 0:
+            self.pending -= 1
+            payloads.append(self.receive())
+        return payloads
+
+
+class RemoteProximityCache:
+    def __init__(
+        self, host, port, tolerance=None, pool_size=4, chunk_size=256, timeout=None, version=0
+    ):
+        """
+        Client of a `CacheServer`, with the lookup and insertion interface of
+        `ProximityCache`, so that it can be passed as the cache of a
+        `ResponseRunner`.
+
+        Connections are pooled, and requests are pipelined: a large lookup is
+        split in chunks of `chunk_size` queries that are all sent before the
+        first answer is read, and insertions return without waiting for the
+        server's acknowledgment (errors are raised by the next request on the
+        same connection).
+
+        The acknowledgment of an insertion carries the evictions, admissions
+        and rejections it caused. `evictions`, `admitted` and `rejected` are the
+        totals of the acknowledgments read so far, so they count the
+        insertions of this client only, and reading them costs no round trip.
+        Since insertions are not awaited, the counts of the last insertions
+        show up once the next request has been sent, or after `flush`.
+
+        Parameters
+        ----------
+        host: str
+            The address of the server.
+
+        port: int
+            The port of the server.
+
+        tolerance: float
+            The tolerance of the lookups of this client. Defaults to the
+            tolerance the server was started with.
+
+        pool_size: int
+            The maximum number of idle connections kept open.
+
+        chunk_size: int
+            The maximum number of queries per request.
+
+        timeout: float
+            Socket timeout in seconds, None to block.
+
+        version: int
+            The version of the entries of this client, see `set_version`.
+        """
+        self.address = (host, port)
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        # [evictions, admitted, rejected] caused by the acknowledged insertions
+        self._counts = np.zeros(3, dtype=np.int64)
+        self._counts_lock = threading.Lock()
+        self.version = int(version)
+        info = self.info()
+        self.capacity = info["capacity"]
+        self.tolerance = info["tolerance"] if tolerance is None else tolerance
+        self.ttl = info["ttl"]
+
+    @contextmanager
+    def _connection(self):
+        try:
+            connection = self._pool.get_nowait()
+        except queue.Empty:
+            connection = _Connection(self.address, self.timeout)
+        try:
+            yield connection
+        except BaseException:
+            # the stream may be out of sync, do not reuse it
+            connection.socket.close()
+            raise
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            self._drain(connection)
+            connection.socket.close()
+
+    def _drain(self, connection):
+        """Read the acknowledgments of the pending insertions of a connection."""
+        payloads = connection.drain()
+        if payloads:
+            counts = np.frombuffer(b"".join(payloads), dtype="<i8").reshape(-1, 3).sum(axis=0)
+            with self._counts_lock:
+                self._counts += counts
+
+    def _request(self, op, n=0, dim=0, value_size=0, param=0.0, *payloads):
+        with self._connection() as connection:
+            self._drain(connection)
+            connection.send(op, n, dim, value_size, param, self.version, *payloads)
+            return connection.receive()
+
+    def flush(self):
+        """Wait for the acknowledgments of all the insertions sent so far."""
+        connections = []
+        while True:
+            try:
+                connections.append(self._pool.get_nowait())
+            except queue.Empty:
+                break
+        for connection in connections:
+            self._drain(connection)
+            self._pool.put_nowait(connection)
+
+    def close(self):
+        while True:
+            try:
+                connection = self._pool.get_nowait()
+            except queue.Empty:
+                return
+            self._drain(connection)
+            connection.socket.close()
+
+    @property
+    def latest_version(self):
+        """
+        The version of the entries this client can see. The server keeps the
+        entries of every version apart, so other clients never change it.
+        """
+        return self.version
+
+    def info(self):
+        """
+        Returns
+        -------
+        dict
+            The capacity, tolerance, dimensions, size, ttl and eviction and
+            admission counts of the server cache, from all its clients.
+        """
+        return json.loads(self._request(OP_INFO).decode())
+
+    def __len__(self):
+        return self.info()["len"]
+
+    @property
+    def evictions(self):
+        return int(self._counts[0])
+
+    @property
+    def admitted(self):
+        return int(self._counts[1])
+
+    @property
+    def rejected(self):
+        return int(self._counts[2])
+
+    def find(self, key):
+        hit_mask, values, _ = self.find_batch(np.asarray(key, dtype=np.float32).reshape(1, -1))
+        return values[0] if hit_mask[0] else None
+
+    def insert(self, key, value):
+        self.insert_batch(np.asarray(key, dtype=np.float32).reshape(1, -1), np.asarray(value).reshape(1, -1))
+
+    def find_batch(self, queries):
+        """
+        Look up a batch of keys, see `ProximityCache.find_batch`.
+
+        Returns
+        -------
+        hit_mask: numpy.ndarray
+            Boolean array of shape (n_queries,).
+
+        values: numpy.ndarray
+            Array of shape (n_queries, value_size), -1 for misses.
+
+        distances: numpy.ndarray
+            Array of shape (n_queries,) with the distance to the closest cached key.
+        """
+        queries = np.ascontiguousarray(queries, dtype="<f4")
+        if queries.ndim == 1:
+            queries = queries.reshape(1, -1)
+        n, dim = queries.shape
+        chunks = [queries[i:i + self.chunk_size] for i in range(0, n, self.chunk_size)] or [queries]
+
+        with self._connection() as connection:
+            self._drain(connection)
+            for chunk in chunks:
+                connection.send(OP_FIND, len(chunk), dim, 0, self.tolerance, self.version, chunk.tobytes())
+            payloads = [connection.receive() for _ in chunks]
+
+        hit_masks, values, distances = [], [], []
+        for chunk, payload in zip(chunks, payloads):
+            (value_size,) = struct.unpack_from("<I", payload)
+            m = len(chunk)
+            offset = 4
+            hit_masks.append(np.frombuffer(payload, dtype=np.uint8, count=m, offset=offset).astype(bool))
+            offset += m
+            values.append(np.frombuffer(payload, dtype="<i8", count=m * value_size, offset=offset).reshape(m, value_size))
+            offset += 8 * m * value_size
+            distances.append(np.frombuffer(payload, dtype="<f4", count=m, offset=offset))
+        return (
+            np.concatenate(hit_masks),
+            np.concatenate(values).astype(np.int64),
+            np.concatenate(distances).astype(np.float32),
+        )
+
+    def insert_batch(self, keys, values):
+        """Insert a batch of entries, see `ProximityCache.insert_batch`. Does not wait for the server."""
+        keys = np.ascontiguousarray(keys, dtype="<f4")
+        if keys.ndim == 1:
+            keys = keys.reshape(1, -1)
+        if len(keys) == 0:
+            return
+        values = np.ascontiguousarray(values, dtype="<i8").reshape(len(keys), -1)
+        with self._connection() as connection:
+            for i in range(0, len(keys), self.chunk_size):
+                chunk_keys, chunk_values = keys[i:i + self.chunk_size], values[i:i + self.chunk_size]
+                connection.send(
+                    OP_INSERT, len(chunk_keys), keys.shape[1], values.shape[1], 0.0, self.version,
+                    chunk_keys.tobytes(), chunk_values.tobytes(),
+                )
+                connection.pending += 1
+
+    def clear(self):
+        self._request(OP_CLEAR)
+
+    def set_version(self, version):
+        """
+        Set the version of the entries this client inserts and looks up, see
+        `ProximityCache.set_version`. It is sent with every request, and does
+        not change the server: entries of other versions, possibly still used
+        by other clients, are left in place and age out through the eviction
+        policy.
+
+        Returns
+        -------
+        int
+            The number of entries invalidated, always 0.
+        """
+        self.version = int(version)
+        return 0
+
+    def save(self, path=None):
+        """
+        Have the server save a snapshot of the cache to its --snapshot
+        directory, see `ProximityCache.save`. Clients cannot choose the
+        location: `path` is ignored, and only accepted for compatibility with
+        `ProximityCache.save` (e.g. checkpoints of `ResponseRunner`).
+        """
+        self._request(OP_SAVE)
+
+    def check_snapshot(self, path):
+        raise NotImplementedError(
+            "A remote cache cannot be restored by the client; start the server with --snapshot instead."
+        )
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        raise NotImplementedError(
+            "A remote cache cannot be loaded by the client; start the server with --snapshot instead."
+        )
+
+
+def main():
+    from instruct_qa.cache.utils import load_cache
+
+    parser = argparse.ArgumentParser(description="Serve a proximity cache over TCP.")
+    parser.add_argument("--cache", type=str, default="lru", help="Cache name, see load_cache.")
+    parser.add_argument("--capacity", type=int, required=True)
+    parser.add_argument("--tolerance", type=float, required=True)
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="Address to listen on. The server has no authentication, only listen on trusted networks.",
+    )
+    parser.add_argument("--port", type=int, default=7007)
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        default=None,
+        help="Snapshot directory to warm start from, if it exists, and to save to on request of a client.",
+    )
+    args = parser.parse_args()
+
+    cache = load_cache(args.cache, args.capacity, args.tolerance)
+    if args.snapshot is not None and (Path(args.snapshot) / "meta.json").exists():
+        cache = type(cache).load(args.snapshot)
+
+    server = CacheServer(cache, host=args.host, port=args.port, snapshot_path=args.snapshot)
+    print(f"Serving {type(cache).__name__} on {server.address[0]}:{server.address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
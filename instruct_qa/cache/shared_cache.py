@@ -0,0 +1,236 @@
+import fcntl
+import os
+import tempfile
+import time
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+
+import numpy as np
+
+from instruct_qa.cache.proximity_cache import ProximityCache
+
+
+def _attach_segment(name):
+    """
+    Attach to an existing shared memory segment without registering it with the
+    resource tracker. Only the creator owns the segment: otherwise the tracker
+    of an attached process would unlink it when that process exits.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no `track` argument
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class SharedMemoryProximityCache(ProximityCache):
+    def __init__(
+        self,
+        capacity,
+        tolerance,
+        dim,
+        value_size,
+        policy=None,
+        name="instruct_qa_cache",
+        create=True,
+        lock_path=None,
+        key_dtype="float32",
+        strict_tolerance=False,
+        admission=None,
+        ttl=None,
+    ):
+        """
+        Proximity cache whose keys, values and policy metadata live in
+        `multiprocessing.shared_memory` segments, so that several runner
+        processes on the same node share a single cache. One process creates
+        the cache (`create=True`), the others attach to it by name with the
+        same arguments (`create=False`).
+
+        Writers (inserts, clear, version changes and expiry) are serialized by an exclusive `flock` on a
+        lock file, and bump a sequence counter before and after writing. Readers
+        take no lock: they retry a lookup if the counter was odd (write in
+        progress) or changed while they were reading (seqlock). The eviction
+        policy is updated on hits without the lock; a concurrent update may be
+        lost, which only affects the choice of the next victims.
+
+        Parameters
+        ----------
+        capacity: int
+            The maximum number of entries in the cache.
+
+        tolerance: float
+            The maximum euclidean distance between a query and a cached key for
+            the lookup to be a hit. It is local to each process.
+
+        dim: int
+            The dimension of the keys. Required, since the segments are
+            allocated up-front.
+
+        value_size: int
+            The number of integers stored per entry.
+
+        policy: str
+            The eviction policy, one of "fifo", "lru" or "lfu".
+
+        name: str
+            The prefix of the shared memory segments and of the default lock file.
+
+        create: bool
+            Whether to create the segments, or attach to existing ones.
+
+        lock_path: str
+            The path of the lock file. Defaults to `<tmpdir>/<name>.lock`.
+
+        key_dtype: str
+            The storage type of the keys, see `ProximityCache`.
+
+        strict_tolerance: bool
+            Whether hits must hold for float32 keys, see `ProximityCache`.
+
+        admission: str
+            The admission filter, None or "tinylfu", see `ProximityCache`. Its
+            sketch is shared, and updated without the lock on lookups.
+
+        ttl: float
+            If not None, the lifetime of the entries in seconds, see `ProximityCache`.
+        """
+        self.name = name
+        self.create = create
+        self._segments = []
+        self._lock_fd = os.open(
+            lock_path or os.path.join(tempfile.gettempdir(), f"{name}.lock"),
+            os.O_CREAT | os.O_RDWR,
+        )
+        self._header = self._new_array("header", (4,), np.int64)
+        if create:
+            self._header[:] = [0, capacity, dim, value_size]
+        elif tuple(self._header[1:]) != (capacity, dim, value_size):
+            raise ValueError(
+                f"Shared cache {name} has (capacity, dim, value_size) {tuple(self._header[1:])}, "
+                f"got {(capacity, dim, value_size)}."
+            )
+        super().__init__(
+            capacity,
+            tolerance,
+            policy=policy,
+            dim=dim,
+            value_size=value_size,
+            key_dtype=key_dtype,
+            strict_tolerance=strict_tolerance,
+            admission=admission,
+            ttl=ttl,
+        )
+
+    def _new_array(self, name, shape, dtype, fill=0):
+        nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        segment_name = f"{self.name}_{name}"
+        if self.create:
+            segment = shared_memory.SharedMemory(name=segment_name, create=True, size=nbytes)
+        else:
+            segment = _attach_segment(segment_name)
+        self._segments.append(segment)
+
+        array = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+        if self.create:
+            preloaded = getattr(self, "_preloaded", {}).pop(name, None)
+            array[...] = fill if preloaded is None else preloaded
+        # the header is allocated before the base constructor, and is not part of snapshots
+        if name != "header":
+            self._arrays[name] = array
+        return array
+
+    # the segment names are local to a node and do not have to match a snapshot
+    _runtime_config = ProximityCache._runtime_config + ("name", "create")
+
+    def _config(self):
+        config = super()._config()
+        config.update(name=self.name, create=True)
+        return config
+
+    def restore_from(self, path):
+        """
+        Copy a snapshot saved with `save` into the existing segments, under the
+        write lock. Unlike `load`, which would try to create the segments
+        again, this restores a cache that attached processes keep sharing.
+
+        Parameters
+        ----------
+        path: str
+            The directory the snapshot was saved to. The snapshot must have the
+            configuration of this cache, see `check_snapshot`.
+        """
+        path = Path(path)
+        meta = self.check_snapshot(path)
+        snapshot = {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in meta["arrays"]}
+        if set(snapshot) != set(self._arrays):
+            raise ValueError(
+                f"Snapshot at {path} has arrays {sorted(snapshot)}, expected {sorted(self._arrays)}."
+            )
+        for name, array in snapshot.items():
+            if array.shape != self._arrays[name].shape or array.dtype != self._arrays[name].dtype:
+                raise ValueError(
+                    f"Snapshot array {name} has shape {array.shape} and dtype {array.dtype}, "
+                    f"expected {self._arrays[name].shape} and {self._arrays[name].dtype}."
+                )
+
+        def restore():
+            for name, array in snapshot.items():
+                self._arrays[name][...] = array
+            self.version = int(self._counters[3])
+            self._restore()
+
+        self._write_locked(restore)
+
+    def close(self):
+        """Detach from the shared memory segments. The creator also destroys them."""
+        self._arrays = {}
+        self._keys = self._sq_norms = self._values = None
+        self._key_scales = self._key_errors = None
+        self._versions = self._inserted_at = None
+        self._valid = self._counters = self._header = None
+        self._policy = self._admission = None
+        for segment in self._segments:
+            segment.close()
+            if self.create:
+                segment.unlink()
+        self._segments = []
+        os.close(self._lock_fd)
+
+    def _write_locked(self, func, *args):
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            # the sequence number is odd while a write is in progress
+            self._header[0] += 1
+            return func(*args)
+        finally:
+            self._header[0] += 1
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def insert_batch(self, keys, values):
+        self._write_locked(super().insert_batch, keys, values)
+
+    def clear(self):
+        self._write_locked(super().clear)
+
+    def set_version(self, version):
+        return self._write_locked(super().set_version, version)
+
+    def expire(self):
+        if self.ttl is None:
+            return 0
+        return self._write_locked(super().expire)
+
+    def _lookup(self, queries):
+        while True:
+            sequence = int(self._header[0])
+            if sequence % 2 == 1:
+                time.sleep(0)
+                continue
+            result = super()._lookup(queries)
+            if int(self._header[0]) == sequence:
+                return result
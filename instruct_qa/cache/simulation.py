@@ -0,0 +1,223 @@
+import multiprocessing as mp
+import time
+from pathlib import Path
+
+import numpy as np
+
+from instruct_qa.cache.utils import load_cache
+
+
+class CacheTrace:
+    def __init__(self, embeddings, indices, search_latency=0.0):
+        """
+        A recorded retrieval workload: the embedding of every query, in arrival
+        order, and the exact top-k passage indices returned by the index for it.
+
+        Parameters
+        ----------
+        embeddings: numpy.ndarray
+            The query embeddings, of shape (n_queries, dim).
+
+        indices: numpy.ndarray
+            The top-k passage indices of each query, of shape (n_queries, k).
+
+        search_latency: float
+            The average index search time per query (in seconds) measured while
+            recording. It is used to model the latency of cache misses.
+        """
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.indices = np.ascontiguousarray(indices, dtype=np.int64)
+        self.search_latency = float(search_latency)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    @property
+    def k(self):
+        return self.indices.shape[1]
+
+    def save(self, path):
+        """Save the trace as an uncompressed .npz file."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            path,
+            embeddings=self.embeddings,
+            indices=self.indices,
+            search_latency=np.float64(self.search_latency),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["embeddings"], data["indices"], float(data["search_latency"]))
+
+
+def record_trace(retriever, queries, k=10, batch_size=32):
+    """
+    Encode `queries` and retrieve their top-k passages once, to be replayed
+    through many cache configurations with `simulate_cache`.
+
+    Parameters
+    ----------
+    retriever: instruct_qa.retrieval.SentenceTransformerRetriever
+        The retriever whose encoder and index define the workload.
+
+    queries: list of strings
+        The queries, in the order they would be served.
+
+    k: int
+        The number of passages to retrieve per query (i.e. db_k).
+
+    batch_size: int
+        The number of queries encoded and searched at once.
+
+    Returns
+    -------
+    CacheTrace
+        The recorded trace.
+    """
+    embeddings = []
+    indices = []
+    search_time = 0.0
+    for i in range(0, len(queries), batch_size):
+        encoded = retriever.encode_queries(queries[i:i + batch_size])
+        t1 = time.time()
+        indices.append(retriever.retrieve(encoded, k=k)["indices"])
+        search_time += time.time() - t1
+        embeddings.append(encoded)
+
+    return CacheTrace(
+        np.concatenate(embeddings),
+        np.concatenate(indices),
+        search_latency=search_time / max(len(queries), 1),
+    )
+
+
+def simulate_cache(trace, cache_name, capacity, tolerance, batch_size=32, **cache_kwargs):
+    """
+    Replay a trace through a cache, as `ResponseRunner.rag_call` would: look up
+    each batch, serve hits from the cache and insert the exact results of the misses.
+
+    Parameters
+    ----------
+    trace: CacheTrace
+        The workload to replay.
+
+    cache_name: str
+        The name of the cache, see `instruct_qa.cache.utils.load_cache`.
+
+    capacity: int
+        The capacity of the cache.
+
+    tolerance: float
+        The tolerance of the cache.
+
+    batch_size: int
+        The number of queries looked up at once.
+
+    **cache_kwargs: dict
+        Additional keyword arguments passed to the cache.
+
+    Returns
+    -------
+    dict
+        - hit_rate: the fraction of queries answered from the cache.
+        - recall: the average recall@k of the served results against the exact
+          ones. Misses are served exact results and count as a recall of 1.
+        - hit_recall: the average recall@k over the hits only.
+        - cache_time: the measured time spent in the cache (lookups and inserts), in seconds.
+        - modeled_latency: cache_time plus the recorded search latency of every miss, in seconds.
+        - baseline_latency: the recorded search latency of every query, i.e. without a cache.
+        - evictions: the number of entries evicted.
+        - rejected: the number of entries rejected by the admission filter, if any.
+    """
+    cache = load_cache(cache_name, capacity, tolerance, **cache_kwargs)
+    n_hits = 0
+    hit_overlap = 0.0
+    cache_time = 0.0
+
+    for i in range(0, len(trace), batch_size):
+        embeddings = trace.embeddings[i:i + batch_size]
+        exact = trace.indices[i:i + batch_size]
+
+        t1 = time.time()
+        hit_mask, values, _ = cache.find_batch(embeddings)
+        cache_time += time.time() - t1
+
+        if hit_mask.any():
+            served = values[hit_mask]
+            overlap = (served[:, :, None] == exact[hit_mask][:, None, :]).any(axis=2)
+            hit_overlap += overlap.sum() / trace.k
+            n_hits += int(hit_mask.sum())
+
+        t1 = time.time()
+        cache.insert_batch(embeddings[~hit_mask], exact[~hit_mask])
+        cache_time += time.time() - t1
+
+    n_queries = len(trace)
+    n_misses = n_queries - n_hits
+    return {
+        "cache_name": cache_name,
+        "capacity": capacity,
+        "tolerance": tolerance,
+        "hit_rate": n_hits / n_queries,
+        "recall": (hit_overlap + n_misses) / n_queries,
+        "hit_recall": hit_overlap / n_hits if n_hits > 0 else float("nan"),
+        "cache_time": cache_time,
+        "modeled_latency": cache_time + n_misses * trace.search_latency,
+        "baseline_latency": n_queries * trace.search_latency,
+        "evictions": cache.evictions,
+        "rejected": cache.rejected,
+    }
+
+
+_worker_trace = None
+
+
+def _init_worker(trace):
+    global _worker_trace
+    _worker_trace = trace
+
+
+def _simulate_config(config):
+    return simulate_cache(_worker_trace, **config)
+
+
+def simulate_caches(trace, configs, n_jobs=-1):
+    """
+    Replay a trace through many cache configurations in parallel processes.
+
+    Parameters
+    ----------
+    trace: CacheTrace
+        The workload to replay. It is sent once to each worker process.
+
+    configs: list of dicts
+        The keyword arguments of `simulate_cache` for each configuration (except
+        the trace), e.g. {"cache_name": "lru", "capacity": 100, "tolerance": 0.5}.
+
+    n_jobs: int, default=-1
+        The number of processes to use. If -1, use all available processes.
+
+    Returns
+    -------
+    list of dicts
+        The result of `simulate_cache` for each configuration, in order.
+
+    Examples
+    --------
+    >>> import itertools
+    >>> configs = [
+    ...     {"cache_name": policy, "capacity": capacity, "tolerance": tolerance}
+    ...     for policy, capacity, tolerance in itertools.product(["fifo", "lru"], [10, 100], [0.5, 1.0])
+    ... ]
+    >>> results = simulate_caches(CacheTrace.load("trace.npz"), configs)
+    """
+    n_jobs = n_jobs if n_jobs > 0 else mp.cpu_count()
+    n_jobs = min(n_jobs, len(configs))
+    if n_jobs <= 1:
+        return [simulate_cache(trace, **config) for config in configs]
+
+    with mp.Pool(n_jobs, initializer=_init_worker, initargs=(trace,)) as pool:
+        return pool.map(_simulate_config, configs, chunksize=1)
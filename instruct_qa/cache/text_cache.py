@@ -0,0 +1,117 @@
+from collections import OrderedDict
+import re
+import time
+
+import numpy as np
+
+
+def normalize_query(query):
+    """Lowercase a query and collapse its whitespace."""
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+class QueryTextCache:
+    def __init__(self, capacity, normalize=normalize_query, ttl=None):
+        """
+        Exact-match LRU cache from the (normalized) text of a query to its
+        retrieval result and embedding. It is meant to sit in front of the query
+        encoder: a hit skips both the encoding and the proximity cache.
+
+        Entries follow the invalidation of the proximity cache behind them:
+        they expire after `ttl` seconds, and are tagged with the version of the
+        proximity cache at insertion, so that lookups with another version
+        miss (see `find_batch`).
+
+        Parameters
+        ----------
+        capacity: int
+            The maximum number of entries in the cache.
+
+        normalize: callable
+            Function applied to queries before hashing them. Defaults to
+            lowercasing and collapsing whitespace. Use `str` for byte-exact matches.
+
+        ttl: float
+            If not None, entries expire `ttl` seconds (wall-clock) after their
+            insertion. `ResponseRunner` defaults it to the `ttl` of its
+            proximity cache.
+        """
+        self.capacity = capacity
+        self.normalize = normalize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def find_batch(self, queries, version=None):
+        """
+        Look up a batch of queries. Expired entries, and entries of another
+        version, are dropped and count as misses.
+
+        Parameters
+        ----------
+        queries: list of strings
+            The text queries.
+
+        version: int
+            The current version of the proximity cache. If None, versions are
+            not checked.
+
+        Returns
+        -------
+        hit_mask: numpy.ndarray
+            Boolean array of shape (n_queries,).
+
+        values: list
+            For each query, the cached retrieval result if it was a hit, None otherwise.
+
+        embeddings: list
+            For each query, the cached embedding if it was a hit, None otherwise.
+        """
+        values = [None] * len(queries)
+        embeddings = [None] * len(queries)
+        hit_mask = np.zeros(len(queries), dtype=bool)
+        oldest = -np.inf if self.ttl is None else time.time() - self.ttl
+        for i, query in enumerate(queries):
+            key = self.normalize(query)
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            value, embedding, entry_version, inserted_at = entry
+            if inserted_at < oldest or (version is not None and entry_version != version):
+                del self._entries[key]
+                continue
+            self._entries.move_to_end(key)
+            values[i], embeddings[i] = value, embedding
+            hit_mask[i] = True
+        return hit_mask, values, embeddings
+
+    def insert_batch(self, queries, values, embeddings, version=None):
+        """
+        Insert a batch of entries, evicting the least recently used ones if needed.
+
+        Parameters
+        ----------
+        queries: list of strings
+            The text queries.
+
+        values: numpy.ndarray
+            The retrieval results, of shape (n_queries, k).
+
+        embeddings: numpy.ndarray
+            The query embeddings, of shape (n_queries, dim).
+
+        version: int
+            The version of the proximity cache the results were computed with.
+        """
+        now = time.time()
+        for query, value, embedding in zip(queries, values, embeddings):
+            key = self.normalize(query)
+            self._entries[key] = (value, embedding, version, now)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
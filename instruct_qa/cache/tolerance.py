@@ -0,0 +1,120 @@
+import numpy as np
+
+
+class AdaptiveToleranceController:
+    def __init__(
+        self,
+        initial_tolerance,
+        target_hit_rate=None,
+        max_drift=None,
+        window=256,
+        gain=1.0,
+        min_tolerance=1e-3,
+        max_tolerance=100.0,
+    ):
+        """
+        Online controller for the tolerance of a proximity cache. Statistics are
+        accumulated over a window of queries, after which the tolerance is
+        updated multiplicatively (i.e. additively in log space), so that the
+        same controller works for tolerances of very different magnitudes.
+
+        Two targets are supported and can be combined:
+
+        - `target_hit_rate`: the tolerance grows when the observed hit rate is
+          below the target and shrinks when it is above.
+        - `max_drift`: an upper bound on the drift of the results, measured as
+          the average distance between queries and their retrieved passages
+          (`avg_dist` in `ResponseRunner.rag_call`). When the bound is exceeded
+          the tolerance shrinks, regardless of the hit rate. If no hit rate
+          target is given, the tolerance grows as long as the drift stays
+          below the bound.
+
+        Parameters
+        ----------
+        initial_tolerance: float
+            The tolerance used for the first window.
+
+        target_hit_rate: float
+            The hit rate to steer towards, in [0, 1].
+
+        max_drift: float
+            The maximum average query-to-passage distance allowed over a window.
+
+        window: int
+            The number of queries between two updates.
+
+        gain: float
+            The step size of the update in log space. With a gain of 1, a hit
+            rate 10 points below target increases the tolerance by ~10%.
+
+        min_tolerance: float
+            The lower bound of the tolerance.
+
+        max_tolerance: float
+            The upper bound of the tolerance.
+        """
+        if target_hit_rate is None and max_drift is None:
+            raise ValueError("At least one of target_hit_rate and max_drift must be specified.")
+
+        self.tolerance = float(initial_tolerance)
+        self.target_hit_rate = target_hit_rate
+        self.max_drift = max_drift
+        self.window = window
+        self.gain = gain
+        self.min_tolerance = min_tolerance
+        self.max_tolerance = max_tolerance
+        self.history = []
+        self._reset_window()
+
+    def _reset_window(self):
+        self._n_queries = 0
+        self._n_hits = 0
+        self._drift_sum = 0.0
+
+    def update(self, n_hits, n_queries, drift=None):
+        """
+        Record the outcome of a batch of lookups, and update the tolerance if
+        the window is complete.
+
+        Parameters
+        ----------
+        n_hits: int
+            The number of cache hits in the batch.
+
+        n_queries: int
+            The number of queries in the batch.
+
+        drift: float
+            The average query-to-passage distance of the batch. Required if
+            `max_drift` is set.
+
+        Returns
+        -------
+        float
+            The tolerance to use for the next batch.
+        """
+        self._n_queries += n_queries
+        self._n_hits += n_hits
+        if self.max_drift is not None:
+            if drift is None:
+                raise ValueError("drift must be provided when max_drift is set.")
+            self._drift_sum += drift * n_queries
+
+        if self._n_queries < self.window:
+            return self.tolerance
+
+        hit_rate = self._n_hits / self._n_queries
+        step = 0.0
+        if self.max_drift is not None and self._drift_sum / self._n_queries > self.max_drift:
+            step = -self.gain * (self._drift_sum / self._n_queries / self.max_drift - 1.0)
+        elif self.target_hit_rate is not None:
+            step = self.gain * (self.target_hit_rate - hit_rate)
+        else:
+            step = self.gain * (1.0 - self._drift_sum / self._n_queries / self.max_drift)
+
+        self.tolerance = float(
+            np.clip(self.tolerance * np.exp(step), self.min_tolerance, self.max_tolerance)
+        )
+        self.history.append((hit_rate, self.tolerance))
+        self._reset_window()
+        return self.tolerance
@@ -0,0 +1,79 @@
+import numpy as np
+
+from instruct_qa.cache import (
+    FifoCache,
+    LruCache,
+    LfuCache,
+    IVFProximityCache,
+    LSHProximityCache,
+)
+
+
+def load_cache(cache_name, capacity, tolerance, **kwargs):
+    """
+    Loads a proximity cache by name.
+
+    Args:
+        cache_name (str): Name of the cache. Either an eviction policy ("fifo",
+            "lru", "lfu") or a cache type ("ivf", "lsh", "shared") that takes the policy
+            as a kwarg.
+        capacity (int): Maximum number of entries in the cache.
+        tolerance (float): Maximum euclidean distance for a lookup to be a hit.
+        kwargs: Additional parameters for the cache (e.g., dim).
+
+    Returns:
+        ProximityCache: The cache object.
+    """
+    if cache_name == "shared":
+        # multiprocessing.shared_memory requires Python 3.8
+        from instruct_qa.cache.shared_cache import SharedMemoryProximityCache
+
+        return SharedMemoryProximityCache(capacity, tolerance, **kwargs)
+
+    cache_mapping = {
+        "fifo": FifoCache,
+        "lru": LruCache,
+        "lfu": LfuCache,
+        "ivf": IVFProximityCache,
+        "lsh": LSHProximityCache,
+    }
+
+    if cache_name not in cache_mapping:
+        raise NotImplementedError(f"Cache {cache_name} not supported.")
+
+    return cache_mapping[cache_name](capacity, tolerance, **kwargs)
+
+
+def coalesce(vectors, tolerance):
+    """
+    Greedily group vectors that lie within `tolerance` of each other, so that a
+    single representative per group can be searched. Groups are built in order:
+    the first ungrouped vector becomes a representative and takes every other
+    ungrouped vector within `tolerance` of it. Every vector is therefore within
+    `tolerance` of its representative, the same guarantee as a cache hit.
+
+    Args:
+        vectors (numpy.ndarray): Array of shape (n, dim).
+        tolerance (float): Maximum euclidean distance to the representative.
+
+    Returns:
+        tuple: `representatives`, the indices of the representative vectors, and
+            `assignment`, an array of shape (n,) with the position in
+            `representatives` of the group of each vector.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    sq_norms = np.einsum("ij,ij->i", vectors, vectors)
+    sq_dist = sq_norms[:, None] - 2.0 * vectors @ vectors.T + sq_norms[None, :]
+    within = sq_dist <= tolerance ** 2
+
+    assignment = np.full(len(vectors), -1, dtype=np.int64)
+    representatives = []
+    # vectors already taken by an earlier representative are skipped
+    for i in range(len(vectors)):
+        if assignment[i] >= 0:
+            continue
+        assignment[within[i] & (assignment < 0)] = len(representatives)
+        assignment[i] = len(representatives)
+        representatives.append(i)
+
+    return np.array(representatives, dtype=np.int64), assignment
@@ -10,6 +10,8 @@ from openai.error import (
 )
 import torch
 from transformers import pipeline
+
+from instruct_qa.generation.kv_cache import PrefixKVCache, reuse_prefix
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
@@ -39,6 +41,7 @@ class BaseGenerator:
         skip_special_tokens=True,
         clean_up_tokenization_spaces=False,
         device="cuda",
+        prefix_cache_size=0,
     ):
         self.model_name = model_name
         self.weights_path = weights_path
@@ -53,6 +56,8 @@ class BaseGenerator:
         self.clean_up_tokenization_spaces = clean_up_tokenization_spaces
         self.device = device
         self.wait = 10
+        # key/value caches of prompt prefixes, see `generate_with_prefixes`
+        self.kv_cache = PrefixKVCache(prefix_cache_size) if prefix_cache_size > 0 else None
 
     def __call__(self, prompt, **kwargs):
         raise NotImplementedError()
@@ -60,6 +65,40 @@ class BaseGenerator:
     def post_process_response(self, response):
         return response
 
+    def generate_with_prefixes(self, prefixes, suffixes):
+        """
+        Generate a response for each prompt `prefix + suffix`, for generators
+        wrapping a HuggingFace causal LM in `self.model`. The key/value cache of
+        each prefix is kept in `self.kv_cache` (if `prefix_cache_size` > 0), so
+        that prompts sharing a prefix, e.g. the same instruction and passages,
+        only prefill their suffix. Each prompt is tokenized as a whole, so the
+        token ids are those of the unsplit prompt (see `reuse_prefix`). Prompts
+        are generated one at a time, since they generally do not share a
+        prefix, and are not truncated.
+        """
+        responses = []
+        for prefix, suffix in zip(prefixes, suffixes):
+            # tokenize the full prompt, so the model sees the same ids as without a prefix
+            input_ids = self.tokenizer(prefix + suffix, return_tensors="pt").input_ids.to(self.device)
+            past_key_values, _ = reuse_prefix(self.model, self.tokenizer, self.kv_cache, prefix, input_ids)
+            generate_ids = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=past_key_values,
+                temperature=self.temperature,
+                top_p=self.top_p,
+                max_new_tokens=self.max_new_tokens,
+                min_new_tokens=self.min_new_tokens,
+            )
+            responses.append(
+                self.tokenizer.decode(
+                    generate_ids[0, input_ids.size(1) :],
+                    skip_special_tokens=self.skip_special_tokens,
+                    clean_up_tokenization_spaces=self.clean_up_tokenization_spaces,
+                )
+            )
+        return responses
+
 
 class GPTx(BaseGenerator):
     def __init__(self, *args, **kwargs):
@@ -149,7 +188,9 @@ class Llama(BaseGenerator):
             self.tokenizer.pad_token = self.tokenizer.eos_token
             self.model.config.pad_token_id = self.model.config.eos_token_id
 
-    def __call__(self, prompts):
+    def __call__(self, prompts, prefixes=None):
+        if prefixes is not None:
+            return self.generate_with_prefixes(prefixes, prompts)
         _input = self.tokenizer(
             prompts,
             return_tensors="pt",
@@ -210,7 +251,9 @@ class Vicuna(BaseGenerator):
             self.tokenizer.pad_token = self.tokenizer.eos_token
             self.model.config.pad_token_id = self.model.config.eos_token_id
 
-    def __call__(self, prompts):
+    def __call__(self, prompts, prefixes=None):
+        if prefixes is not None:
+            return self.generate_with_prefixes(prefixes, prompts)
         _input = self.tokenizer(
             prompts,
             return_tensors="pt",
@@ -249,7 +292,9 @@ class OPT(BaseGenerator):
             device_map="auto",
         )
 
-    def __call__(self, prompts):
+    def __call__(self, prompts, prefixes=None):
+        if prefixes is not None:
+            return self.generate_with_prefixes(prefixes, prompts)
         _input = self.tokenizer(
             prompts,
             return_tensors="pt",
@@ -0,0 +1,171 @@
+from collections import OrderedDict
+import hashlib
+
+
+def to_legacy_cache(past_key_values):
+    """Convert a transformers `Cache` object to a tuple of (key, value) tensors per layer."""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    if hasattr(past_key_values, "layers"):
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    return past_key_values
+
+
+def from_legacy_cache(past_key_values):
+    """
+    Convert a tuple of (key, value) tensors per layer to a new transformers
+    `DynamicCache`. Models append to the cache they are given with
+    `torch.cat`, so the tensors of `past_key_values` are left unchanged.
+    """
+    from transformers import DynamicCache
+
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(past_key_values)
+    return DynamicCache(past_key_values)
+
+
+def crop_legacy_cache(past_key_values, length):
+    """Keep the first `length` positions of a tuple of (key, value) tensors per layer."""
+    return tuple((key[..., :length, :], value[..., :length, :]) for key, value in past_key_values)
+
+
+def common_prefix_length(ids, other_ids):
+    """The number of leading tokens shared by two 1-D tensors of token ids."""
+    length = min(len(ids), len(other_ids))
+    mismatch = (ids[:length] != other_ids[:length]).nonzero()
+    return int(mismatch[0, 0]) if len(mismatch) > 0 else length
+
+
+def reuse_prefix(model, tokenizer, kv_cache, prefix, input_ids):
+    """
+    Returns the key/value cache of the first tokens of `input_ids`, the
+    tokenization of a full prompt starting with the text `prefix`, reusing the
+    state cached for `prefix` in `kv_cache` (a `PrefixKVCache`, or None).
+
+    The prefix is never tokenized on its own: tokenizers do not always split
+    the full prompt at the end of the prefix (e.g. SentencePiece merges the
+    space before a word into the word), so the state of the prefix tokenized
+    alone would not match the tokens of the full prompt. Instead, the cached
+    state covers the tokens the prefix shares with the full prompt, and it is
+    cropped to the tokens shared with each new prompt. The model therefore
+    sees exactly the token ids of the unsplit prompt.
+
+    Parameters
+    ----------
+    model: transformers.PreTrainedModel
+        The causal language model.
+
+    tokenizer: transformers.PreTrainedTokenizer
+        The tokenizer of the model.
+
+    kv_cache: PrefixKVCache
+        The cache of prefix states. If None, nothing is reused.
+
+    prefix: str
+        The text the prompt starts with.
+
+    input_ids: torch.Tensor
+        The token ids of the full prompt, of shape (1, n_tokens).
+
+    Returns
+    -------
+    past_key_values: transformers.DynamicCache or None
+        The key/value cache of the first `length` tokens, or None if no state
+        is reused.
+
+    length: int
+        The number of tokens covered by `past_key_values`. It is always smaller
+        than the length of the prompt, so that at least one token is prefilled.
+    """
+    import torch
+
+    entry = kv_cache.get(prefix) if kv_cache is not None else None
+    if entry is None:
+        if kv_cache is None:
+            return None, 0
+        prefix_ids = tokenizer(prefix, return_tensors="pt").input_ids.to(input_ids.device)
+        length = min(common_prefix_length(prefix_ids[0], input_ids[0]), input_ids.shape[1] - 1)
+        if length == 0:
+            return None, 0
+        with torch.no_grad():
+            outputs = model(input_ids[:, :length], use_cache=True)
+        entry = (input_ids[:, :length], to_legacy_cache(outputs.past_key_values))
+        kv_cache.put(prefix, *entry)
+
+    cached_ids, past_key_values = entry
+    length = min(common_prefix_length(cached_ids[0], input_ids[0]), input_ids.shape[1] - 1)
+    if length == 0:
+        return None, 0
+    if length < cached_ids.shape[1]:
+        past_key_values = crop_legacy_cache(past_key_values, length)
+    return from_legacy_cache(past_key_values), length
+
+
+class PrefixKVCache:
+    def __init__(self, max_entries=32, max_tokens=None):
+        """
+        Bounded LRU store of the key/value cache (`past_key_values`) of prompt
+        prefixes, keyed by a hash of the prefix text. When the retrieval cache
+        hits, the passages, and therefore the prefix of the prompt, are
+        identical to a previous request, so only the question suffix has to be
+        prefilled by the model.
+
+        Entries are stored as legacy tuples of (key, value) tensors per layer,
+        which the models never modify in place, so an entry can be reused any
+        number of times. The stored input ids are the tokens of a full prompt
+        covered by the entry, see `reuse_prefix`.
+
+        Parameters
+        ----------
+        max_entries: int
+            The maximum number of prefixes kept.
+
+        max_tokens: int
+            If not None, the maximum total number of prefix tokens kept, which
+            bounds the memory used by the entries.
+        """
+        self.max_entries = max_entries
+        self.max_tokens = max_tokens
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._n_tokens = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(prefix):
+        return hashlib.sha1(prefix.encode()).hexdigest()
+
+    def clear(self):
+        self._entries.clear()
+        self._n_tokens = 0
+
+    def get(self, prefix):
+        """
+        Returns
+        -------
+        tuple or None
+            The (prefix input ids, past_key_values) stored for `prefix`, or None.
+        """
+        key = self.key(prefix)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, prefix, input_ids, past_key_values):
+        past_key_values = to_legacy_cache(past_key_values)
+        key = self.key(prefix)
+        if key in self._entries:
+            self._n_tokens -= self._entries.pop(key)[0].shape[-1]
+        self._entries[key] = (input_ids, past_key_values)
+        self._n_tokens += input_ids.shape[-1]
+        while len(self._entries) > self.max_entries or (
+            self.max_tokens is not None and self._n_tokens > self.max_tokens and len(self._entries) > 1
+        ):
+            self._n_tokens -= self._entries.popitem(last=False)[1][0].shape[-1]
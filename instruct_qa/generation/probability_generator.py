@@ -2,25 +2,71 @@ from transformers import AutoModelForCausalLM, AutoTokenizer
 import torch
 import torch.nn.functional as F
 
+from instruct_qa.generation.kv_cache import reuse_prefix
+
 class ProbabilityGenerator:
-    def __init__(self, model, tokenizer):
+    def __init__(self, model, tokenizer, kv_cache=None):
         self.model = model
         self.tokenizer = tokenizer
+        # PrefixKVCache reused across calls sharing the same prefix
+        self.kv_cache = kv_cache
+
+    def next_token_logits(self, sentence, prefix=None):
+        """
+        Returns the logits of the token following the prompt `prefix + sentence`
+        (or `sentence` if `prefix` is None).
 
-    def __call__(self, sentence, k=100):
+        The full prompt is always tokenized at once, so the model sees the same
+        token ids whether or not a prefix is given. With a prefix, the
+        key/value cache of the tokens it shares with the prompt is reused, so
+        that only the remaining tokens are prefilled.
+        """
         self.model.eval()
-        input_ids = self.tokenizer(sentence, return_tensors='pt').input_ids.cuda()
 
+        prompt = sentence if prefix is None else prefix + sentence
+        input_ids = self.tokenizer(prompt, return_tensors='pt').input_ids.cuda()
+        past_key_values, length = None, 0
+        if prefix is not None:
+            past_key_values, length = reuse_prefix(
+                self.model, self.tokenizer, self.kv_cache, prefix, input_ids
+            )
         with torch.no_grad():
-            outputs = self.model(input_ids)
-            logits = outputs.logits
+            outputs = self.model(
+                input_ids[:, length:], past_key_values=past_key_values, use_cache=past_key_values is not None
+            )
+        return outputs.logits[0, -1, :]
+
+    def check_prefix(self, sentence, prefix, atol=1e-3):
+        """
+        Check that reusing the key/value cache of `prefix` gives the logits of
+        the unsplit prompt `prefix + sentence`, up to `atol`.
+
+        Returns
+        -------
+        float
+            The largest absolute difference between the two sets of logits.
+        """
+        split_logits = self.next_token_logits(sentence, prefix=prefix)
+        logits = self.next_token_logits(prefix + sentence)
+        error = float((split_logits.float() - logits.float()).abs().max())
+        if error > atol:
+            raise ValueError(
+                f"Logits with the cached prefix differ from the unsplit prompt by {error:.2e} > {atol:.2e}."
+            )
+        return error
 
+    def __call__(self, sentence, k=100, prefix=None):
+        """
+        Returns the k most likely next tokens after the prompt.
 
-        last_token_logits = logits[0, -1, :]
+        If `prefix` is given, the prompt is `prefix + sentence`, and the
+        key/value cache of the prefix is reused (see `next_token_logits`).
+        """
+        last_token_logits = self.next_token_logits(sentence, prefix=prefix)
         probabilities = F.softmax(last_token_logits, dim=-1)
         top_k_probs, top_k_indices = torch.topk(probabilities, k)
 
         top_k_tokens = self.tokenizer.convert_ids_to_tokens(top_k_indices)
         top_k_tokens = [self.tokenizer.convert_tokens_to_string([tok]) for tok in top_k_tokens]
 
-        return top_k_tokens
\ No newline at end of file
+        return top_k_tokens
@@ -15,6 +15,26 @@ class PromptTemplate:
         """
         return self.template.format(**input_variables)
 
+    def format_split(self, input_variables, split_variable="query"):
+        """
+        Returns the prompt as a (prefix, suffix) pair of strings, split before
+        `split_variable` and the whitespace preceding it, so that
+        `prefix + suffix == format(input_variables)`. Prompts sharing the same
+        prefix (e.g. the instruction and passages) can then reuse the model's
+        key/value cache of the prefix.
+
+        Tokenizers usually attach a space to the word that follows it, so the
+        whitespace goes with the suffix, and the prefix ends where the full
+        prompt is most likely split into tokens.
+        """
+        marker = "{" + split_variable + "}"
+        if marker not in self.template:
+            raise ValueError(f"The template has no {marker} variable to split on.")
+        head, tail = self.template.split(marker, 1)
+        prefix = head.format(**input_variables)
+        stripped = prefix.rstrip()
+        return stripped, prefix[len(stripped):] + (marker + tail).format(**input_variables)
+
     def get_template(self):
         return self.template
 
@@ -99,6 +119,16 @@ class QAPromptTemplate(PromptTemplate):
         )
         return prompt
 
+    def split(self, sample, passages):
+        """
+        Returns the prompt of `__call__` as a (prefix, suffix) pair: the
+        instruction and passages, then the question.
+        """
+        serialized_passages = self.passage_template.serialize_passages(passages)
+        return self.format_split(
+            {"query": sample.question, "retrieved_passages": serialized_passages}
+        )
+
 
 class LlamaChatQAPromptTemplate(QAPromptTemplate):
     def __init__(self):
@@ -164,6 +194,21 @@ class ConvQAPromptTemplate(PromptTemplate):
         )
         return prompt
 
+    def split(self, sample, passages):
+        """
+        Returns the prompt of `__call__` as a (prefix, suffix) pair: the
+        instruction, passages and history, then the question.
+        """
+        serialized_passages = self.passage_template.serialize_passages(passages)
+        serialized_history = self.history_template.serialize_history(sample.context)
+        return self.format_split(
+            {
+                "query": sample.question,
+                "retrieved_passages": serialized_passages,
+                "history": serialized_history,
+            }
+        )
+
 
 class LlamaChatConvQAPromptTemplate(ConvQAPromptTemplate):
     def __init__(self):
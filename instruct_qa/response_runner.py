@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 from pathlib import Path
@@ -7,6 +8,8 @@ import re
 import time
 
 from instruct_qa.retrieval.utils import dict_values_list_to_numpy
+from instruct_qa.cache.utils import coalesce
+from instruct_qa.runner_stats import RunnerStats, CACHE_HIT, COALESCED, TEXT_HIT
 from instruct_qa.dataset.qa import GenericQADataset
 from instruct_qa.generation import ProbabilityGenerator
 
@@ -36,18 +39,69 @@ class ResponseRunner:
         hosted_retriever_url="http://10.140.16.91:42010/search",
         use_cached_retrieved_results=False,
         post_process_response=False,
+        tolerance_controller=None,
+        cache_snapshot_path=None,
+        cache_checkpoint_interval=None,
+        coalesce_misses=True,
+        text_cache=None,
+        compute_avg_dist=True,
+        passage_embeddings=None,
+        answer_cache=None,
+        kv_cache=None,
     ):
         self._model = model
-        self._probamodel = ProbabilityGenerator(model.model, model.tokenizer)
+        # with a PrefixKVCache, prompts are split before the question so that
+        # prompts with the same passages reuse the key/value cache of their prefix
+        self._probamodel = ProbabilityGenerator(model.model, model.tokenizer, kv_cache=kv_cache)
+        self._split_prompts = kv_cache is not None and hasattr(prompt_template, "split")
         self._retriever = retriever
         self._document_collection = document_collection
         self._prompt_template = prompt_template
         self.timings = timings
         self.cache = cache
+        if cache is None and (cache_snapshot_path is not None or cache_checkpoint_interval):
+            raise ValueError("cache_snapshot_path and cache_checkpoint_interval require a cache.")
+        if cache_checkpoint_interval and cache_snapshot_path is None:
+            raise ValueError("cache_checkpoint_interval requires a cache_snapshot_path to save checkpoints to.")
+        self.cache_snapshot_path = cache_snapshot_path
+        self.cache_checkpoint_interval = cache_checkpoint_interval
+        # processes attached to a shared cache neither restore nor write checkpoints: its creator does
+        self._owns_cache = getattr(cache, "create", True)
+        if cache_snapshot_path is not None and (Path(cache_snapshot_path) / "meta.json").exists():
+            # warm start from the last checkpoint instead of an empty cache
+            if hasattr(cache, "restore_from"):
+                if self._owns_cache:
+                    cache.restore_from(cache_snapshot_path)
+            else:
+                # the snapshot replaces the cache, so it must have been saved with the same configuration
+                cache.check_snapshot(cache_snapshot_path)
+                self.cache = type(cache).load(cache_snapshot_path, mmap=True)
+                self.cache.tolerance = cache.tolerance
         self.cache_hit = 0
+        self.stats = RunnerStats()
         self.cache_depth = cache_depth
+        # number of candidates stored per cache entry; hits re-rank them down to db_k
+        self._depth = max(cache_depth, db_k)
         self.use_rag = use_rag
         self.db_k = db_k
+        self.coalesce_misses = coalesce_misses
+        self.text_cache = text_cache
+        if text_cache is not None and text_cache.ttl is None:
+            text_cache.ttl = getattr(self.cache, "ttl", None)
+        self.compute_avg_dist = compute_avg_dist
+        # precomputed passage vectors: an array (possibly a memmap) or the path of a .npy file
+        if isinstance(passage_embeddings, (str, Path)):
+            passage_embeddings = np.load(passage_embeddings, mmap_mode="r")
+        self._passage_embeddings = passage_embeddings
+        self.answer_cache = answer_cache
+        # running mean of the generation time of one prompt, to estimate the time saved by answer hits
+        self._generation_time = 0.0
+        self._n_generated = 0
+        self.tolerance_controller = tolerance_controller
+        if tolerance_controller is not None and tolerance_controller.max_drift is not None and not compute_avg_dist:
+            raise ValueError("A tolerance controller with max_drift requires compute_avg_dist=True.")
+        if tolerance_controller is not None:
+            self.cache.tolerance = tolerance_controller.tolerance
 
         # either dataset or queries should be specified, but not both
         assert (dataset is None) != (queries is None), "Either dataset or queries should be specified, but not both"
@@ -63,40 +117,142 @@ class ResponseRunner:
         self._use_cached_retrieved_results = use_cached_retrieved_results
         self._collection_name = document_collection.get_name()
         self._post_process_response = post_process_response
+        if self.cache is not None:
+            self._cache_counts = (self.cache.evictions, self.cache.rejected)
+            # drop cached results (e.g. from a snapshot) computed on another index
+            if getattr(retriever, "index", None) is not None:
+                self.cache.set_version(self.index_version(retriever.index))
+
+    def _cache_count_deltas(self):
+        """
+        The evictions and rejections of the cache since the previous call. The
+        counters are read once per batch, since reading them is a round trip
+        for some caches.
+        """
+        counts = (self.cache.evictions, self.cache.rejected)
+        previous, self._cache_counts = self._cache_counts, counts
+        return counts[0] - previous[0], counts[1] - previous[1]
+
+    def index_version(self, index):
+        """The version cache entries are tagged with: a hash of the index fingerprint and the collection name."""
+        key = f"{index.fingerprint()}:{self._collection_name}".encode()
+        return int(hashlib.sha1(key).hexdigest()[:15], 16)
+
+    def swap_index(self, index, passage_embeddings=None):
+        """
+        Replace the index of the retriever, e.g. after a rebuild, without
+        restarting the runner. Cached results computed on the previous index
+        are invalidated, unless the new index has the same fingerprint.
+
+        Parameters
+        ----------
+        index: IndexBase
+            The new index.
+
+        passage_embeddings: numpy.ndarray or str
+            The precomputed passage embeddings of the new index, or the path of
+            a .npy file. If None, they are read from the index.
+        """
+        if isinstance(passage_embeddings, (str, Path)):
+            passage_embeddings = np.load(passage_embeddings, mmap_mode="r")
+        version = self.index_version(index)
+        self._retriever.index = index
+        self._passage_embeddings = passage_embeddings
+        if self.cache is not None and version != self.cache.version:
+            self.cache.set_version(version)
+            if self.text_cache is not None:
+                self.text_cache.clear()
+
+    def make_prompt(self, sample, passages):
+        """The prompt of a sample, as a (prefix, suffix) pair if prompts are split for key/value cache reuse."""
+        if self._split_prompts:
+            return self._prompt_template.split(sample=sample, passages=passages)
+        return self._prompt_template(sample=sample, passages=passages)
 
     def post_process_response(self, response):
         return self._model.post_process_response(response)
 
     def rag_call(self, batch, queries):
+        t1 = time.time()
 
+        # exact-text tier: repeated queries skip the encoder and the proximity cache
+        text_hits = np.zeros(len(queries), dtype=bool)
+        if self.text_cache is not None:
+            # the latest version also reflects changes made by other users of a shared cache
+            text_hits, text_values, text_embeddings = self.text_cache.find_batch(
+                queries, version=self.cache.latest_version
+            )
+        text_found = np.flatnonzero(text_hits)
+        to_encode = np.flatnonzero(~text_hits)
+        tiers = np.where(text_hits, TEXT_HIT, 0).astype(np.int8)
+        nn_distance = np.where(text_hits, 0.0, np.nan).astype(np.float32)
 
-        ## transform text to vectors
-        t1 = time.time()
-        encoded = self._retriever.encode_queries(queries)
+        ## transform text to vectors, only for the text misses
+        parts = []
+        if len(to_encode) > 0:
+            parts.append((to_encode, self._retriever.encode_queries([queries[i] for i in to_encode])))
+        if len(text_found) > 0:
+            parts.append((text_found, np.stack([text_embeddings[i] for i in text_found])))
+        encoded = np.empty((len(queries), parts[0][1].shape[1]), dtype=parts[0][1].dtype)
+        for rows, part in parts:
+            encoded[rows] = part
         t2 = time.time()
 
-        # check in the cache. Todo batch search in Rust code 
-        cache_res = []
-        for to_search in encoded:
-            cache_res.append(self.cache.find(list(to_search)))
-        indices_found = [i for i in range(len(encoded)) if cache_res[i] is not None]
-        indices_not_found = [i for i in range(len(encoded)) if cache_res[i] is None]
-        self.cache_hit += len(indices_found)
-
         # retrieved indices is the cache/db returned value for all vectors in batch
-        # for now, it has results from the cache and None where there was no match
-        # so we then ask the DB wherever it is None
-        retrieved_indices = cache_res
+        # it is filled from the text tier and the proximity cache for hits, then from the DB for misses
+        retrieved_indices = np.empty((len(queries), self.db_k), dtype=np.int64)
+        if len(text_found) > 0:
+            retrieved_indices[text_found] = np.stack([text_values[i] for i in text_found])
 
+        # check the remaining queries in the cache at once
+        tolerance = self.cache.tolerance
+        indices_found = indices_not_found = np.empty(0, dtype=np.int64)
+        if len(to_encode) > 0:
+            hit_mask, cache_values, cache_distances = self.cache.find_batch(encoded[to_encode])
+            indices_found = to_encode[hit_mask]
+            indices_not_found = to_encode[~hit_mask]
+            tiers[indices_found] = CACHE_HIT
+            nn_distance[to_encode] = cache_distances
+            if len(indices_found) > 0:
+                retrieved_indices[indices_found] = self.select_candidates(
+                    encoded[indices_found], cache_values[hit_mask]
+                )
+        self.cache_hit += len(text_found) + len(indices_found)
+
+        searches_saved = 0
         if len(indices_not_found) > 0:
-            # db calls for the cache misses
-            missed = np.array([encoded[i] for i in indices_not_found])
-            r_dict = self._retriever.retrieve(missed, k=self.db_k)["indices"]
+            # misses within tolerance of each other share a single db call
+            missed = encoded[indices_not_found]
+            if self.coalesce_misses:
+                representatives, assignment = coalesce(missed, tolerance)
+            else:
+                representatives = assignment = np.arange(len(missed))
+            searches_saved = len(missed) - len(representatives)
+
+            # db calls for the cache misses, as deep as the cache entries
+            r_dict = self._retriever.retrieve(missed[representatives], k=self._depth)["indices"]
 
-            # update the cache and the retrieved indices
-            for (r_dict_i, cache_res_i) in enumerate(indices_not_found):
-                retrieved_indices[cache_res_i] = r_dict[r_dict_i]
-                self.cache.insert(list(encoded[cache_res_i]), list(retrieved_indices[cache_res_i]))
+            # update the cache and the retrieved indices. The search results are
+            # sorted, so representatives keep their top db_k, while the other
+            # members of each group re-rank the candidates of their representative
+            retrieved_indices[indices_not_found] = r_dict[assignment, :self.db_k]
+            followers = np.ones(len(missed), dtype=bool)
+            followers[representatives] = False
+            if followers.any():
+                tiers[indices_not_found[followers]] = COALESCED
+                retrieved_indices[indices_not_found[followers]] = self.select_candidates(
+                    missed[followers], r_dict[assignment[followers]]
+                )
+            self.cache.insert_batch(missed[representatives], r_dict)
+        evictions, rejections = self._cache_count_deltas()
+
+        if self.text_cache is not None and len(to_encode) > 0:
+            self.text_cache.insert_batch(
+                [queries[i] for i in to_encode],
+                retrieved_indices[to_encode],
+                encoded[to_encode],
+                version=self.cache.version,
+            )
 
         t3 = time.time()
 
@@ -107,48 +263,103 @@ class ResponseRunner:
 
         t4 = time.time()
 
-        distances = []
-        for i in range(len(encoded)):
-            encoded_passages = self._retriever.encode_queries(passages[i]) #(20, 768)
-            encoded_query = encoded[i]
-            distances.append(np.linalg.norm(encoded_passages - encoded_query, axis=1))
-        distances = np.mean(distances)
-
-        prompts = [
-            self._prompt_template(
-                sample=sample,
-                passages=p,
+        distances = query_distances = None
+        if self.compute_avg_dist:
+            encoded_passages = self.get_passage_embeddings(retrieved_indices, passages) #(B, k, 768)
+            query_distances = np.linalg.norm(encoded_passages - encoded[:, None, :], axis=2).mean(axis=1)
+            distances = np.mean(query_distances)
+
+        if self.tolerance_controller is not None:
+            # the tolerance only affects the queries looked up in the proximity cache, not the text hits
+            drift = None
+            if query_distances is not None:
+                drift = float(np.mean(query_distances[to_encode])) if len(to_encode) > 0 else 0.0
+            self.cache.tolerance = self.tolerance_controller.update(
+                len(indices_found), len(to_encode), drift=drift
             )
-            for sample, p in zip(batch, passages)
-        ]
-        return prompts, {"avg_dist" : distances, "hit" : len(indices_not_found) < len(indices_found), "encoding" : t2 - t1, "search" : t3 - t2, "fetch_doc" : t4 - t3}
+
+        prompts = [self.make_prompt(sample, p) for sample, p in zip(batch, passages)]
+        return prompts, encoded, {
+            "tiers": tiers,
+            "nn_distance": nn_distance,
+            "avg_dist": distances,
+            "tolerance": tolerance,
+            "searches_saved": searches_saved,
+            "evictions": evictions,
+            "rejections": rejections,
+            "encoding": t2 - t1,
+            "search": t3 - t2,
+            "fetch_doc": t4 - t3,
+        }
 
     def get_probas(self, k):
+        """
+        Returns the top-k tokens of the model for each query, and the
+        `RunnerStats` of the run (also available as `self.stats`).
+        """
         INTERNAL_BATCH_SIZE = self._batch_size
         batches = [
             self._dataset[i:i+INTERNAL_BATCH_SIZE]
             for i in range(0, len(self._dataset), INTERNAL_BATCH_SIZE)
         ]
         ret = []
-        trags = []
-        for batch in batches:
+        if self.answer_cache is not None:
+            namespace = self.answer_cache.namespace(
+                getattr(self._model, "model_name", None) or type(self._model).__name__,
+                type(self._prompt_template).__name__,
+                getattr(self._prompt_template, "template", None),
+                self.use_rag,
+                self.db_k,
+                # answers depend on the index through the retrieved passages
+                self.cache.version if self.cache is not None else None,
+                k,
+            )
+        for batch_i, batch in enumerate(batches):
             queries = self._dataset.get_queries(batch)
+            encoded = None
             if self.use_rag:
-                prompts, trag = self.rag_call(batch, queries)
+                prompts, encoded, trag = self.rag_call(batch, queries)
             else:
                 prompts = [
-                    self._prompt_template(
-                        sample=sample,
-                        passages=[{"title" : "Not Found", "text" : "No corresponding source was found."}],
+                    self.make_prompt(
+                        sample,
+                        [{"title" : "Not Found", "text" : "No corresponding source was found."}],
                     )
                     for sample in batch
                 ]
                 trag = {}
-                retrieved_indices = [0] * self._k
-            for p in prompts: # no LLM batching but we don't care, it's not part of the measured DB query latency
-                ret.append(self._probamodel(p, k))
-            trags.append(trag)
-        return ret, trags
+
+            answers = [None] * len(prompts)
+            answer_hits = np.zeros(len(prompts), dtype=bool)
+            if self.answer_cache is not None:
+                if encoded is None:
+                    encoded = self._retriever.encode_queries(queries)
+                answer_hits, answers = self.answer_cache.find_batch(namespace, encoded)
+            misses = np.flatnonzero(~answer_hits)
+
+            t1 = time.time()
+            for i in misses: # no LLM batching but we don't care, it's not part of the measured DB query latency
+                if self._split_prompts:
+                    prefix, suffix = prompts[i]
+                    answers[i] = self._probamodel(suffix, k, prefix=prefix)
+                else:
+                    answers[i] = self._probamodel(prompts[i], k)
+            generation = time.time() - t1
+            if len(misses) > 0:
+                self._n_generated += len(misses)
+                self._generation_time += (generation / len(misses) - self._generation_time) * len(misses) / self._n_generated
+            if self.answer_cache is not None:
+                self.answer_cache.insert_batch(namespace, encoded[misses], [answers[i] for i in misses])
+                trag["generation_saved"] = int(answer_hits.sum()) * self._generation_time
+            ret.extend(answers)
+            self.stats.add_batch(len(prompts), answer_hits=answer_hits, generation=generation, **trag)
+            if (
+                self.cache_checkpoint_interval
+                and self._owns_cache
+                and (batch_i + 1) % self.cache_checkpoint_interval == 0
+            ):
+                self.cache.save(self.cache_snapshot_path)
+        return ret, self.stats
 
     def _write_results_to_file(self, results):
         # Use pathlib to create a folder of the output path if it is not created
@@ -157,11 +368,64 @@ class ResponseRunner:
         with open(self._output_path, "a") as f:
             f.writelines(json.dumps(result) + "\n" for result in results)
 
-    def recompute_embeddings(passages):
+    def get_passage_embeddings(self, indices, passages=None):
+        """
+        Returns the embeddings of the passages at `indices`, an array of shape
+        (n_queries, k), as an array of shape (n_queries, k, dim). They are read
+        from the precomputed passage embeddings if given, otherwise from the
+        index. Only if the index cannot provide them are the `passages` re-encoded.
+        """
+        indices = np.asarray(indices)
+        if passages is None:
+            passages = [self._document_collection.get_passages_from_indices(i) for i in indices]
+        if self._passage_embeddings is not None:
+            embeddings = self._passage_embeddings[indices.ravel()]
+        else:
+            try:
+                embeddings = self._retriever.index.get_embeddings_from_indices(indices.ravel())
+            except NotImplementedError:
+                return np.stack([self.recompute_embeddings(p) for p in passages])
+        return np.asarray(embeddings, dtype=np.float32).reshape(*indices.shape, -1)
+
+    def recompute_embeddings(self, passages):
         return self._retriever.encode_queries(passages)
 
-    def rerank(target, embeddings):
-        print(target)
-        print("-----")
-        print(embeddings)
-        return range(len(embeddings))
+    def select_candidates(self, queries, candidates):
+        """
+        Returns the best db_k of the `candidates` passage indices, an array of
+        shape (n_queries, depth), for each of the `queries` embeddings. If the
+        candidates are not deeper than db_k, they are returned as is.
+        """
+        if candidates.shape[1] <= self.db_k:
+            return candidates
+        order = self.rerank(queries, self.get_passage_embeddings(candidates), self.db_k)
+        return np.take_along_axis(candidates, order, axis=1)
+
+    def rerank(self, target, embeddings, k):
+        """
+        Re-score candidate passages against their query by inner product.
+
+        Parameters
+        ----------
+        target: numpy.ndarray
+            The query embeddings, of shape (n_queries, dim).
+
+        embeddings: numpy.ndarray
+            The candidate passage embeddings, of shape (n_queries, depth, dim).
+
+        k: int
+            The number of candidates to keep.
+
+        Returns
+        -------
+        numpy.ndarray
+            The positions of the best k candidates of each query, by decreasing
+            score, of shape (n_queries, k).
+        """
+        scores = np.einsum("nd,nkd->nk", target, embeddings)
+        if k < scores.shape[1]:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+        return np.take_along_axis(top, order, axis=1)
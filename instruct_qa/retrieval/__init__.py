@@ -2,6 +2,7 @@ import json
 import numpy as np
 
 from instruct_qa.retrieval.index import IndexBase, IndexTorchFlat, IndexFaissFlatIP
+from instruct_qa.retrieval.embedding_memo import EmbeddingMemo
 
 
 class RetrieverBase:
@@ -49,7 +50,14 @@ class RetrieverFromFile(RetrieverBase):
 
 
 class SentenceTransformerRetriever(RetrieverBase):
-    def __init__(self, query_model, doc_model=None, index: IndexBase = None):
+    def __init__(
+        self,
+        query_model,
+        doc_model=None,
+        index: IndexBase = None,
+        embedding_memo: EmbeddingMemo = None,
+        model_name: str = None,
+    ):
         """
         Parameters
         ----------
@@ -62,8 +70,21 @@ class SentenceTransformerRetriever(RetrieverBase):
         index: instruct_qa.retrieval.index.IndexBase
             The index used to retrieve documents. If you don't provide one, you
             must create one with `build_index`.
+
+        embedding_memo: instruct_qa.retrieval.embedding_memo.EmbeddingMemo
+            If provided, query embeddings are memoized in it and only the texts
+            that are not memoized are encoded.
+
+        model_name: str
+            The name of the query model, used to key the memoized embeddings.
+            Required if an embedding_memo is provided.
         """
+        if embedding_memo is not None and model_name is None:
+            raise ValueError("model_name must be provided when using an embedding_memo.")
+
         self.query_model = query_model
+        self.embedding_memo = embedding_memo
+        self.model_name = model_name
 
         if doc_model is None:
             self.doc_model = self.query_model
@@ -77,9 +98,35 @@ class SentenceTransformerRetriever(RetrieverBase):
         queries: list of strings
             The list of text queries to encode into embeddings.
         **kwargs: dict
-            Additional keyword arguments to pass to the query encoder.
+            Additional keyword arguments to pass to the query encoder. The
+            embedding memo is bypassed when any are given, since they may
+            change the output.
+
+        Notes
+        -----
+        Only lists of strings are memoized. Other inputs, such as a single
+        string or passage dicts re-encoded by `ResponseRunner`, are encoded
+        directly, as are empty lists so that the encoder decides the shape of
+        the result.
         """
-        return self.query_model.encode(queries, **kwargs)
+        if (
+            self.embedding_memo is None
+            or kwargs
+            or isinstance(queries, str)
+            or len(queries) == 0
+            or not all(isinstance(q, str) for q in queries)
+        ):
+            return self.query_model.encode(queries, **kwargs)
+
+        memoized = self.embedding_memo.get_many(self.model_name, queries)
+        missing = list(dict.fromkeys(q for q, e in zip(queries, memoized) if e is None))
+        if missing:
+            encoded = self.query_model.encode(missing)
+            self.embedding_memo.put_many(self.model_name, missing, encoded)
+            encoded = dict(zip(missing, encoded))
+            memoized = [encoded[q] if e is None else e for q, e in zip(queries, memoized)]
+
+        return np.stack(memoized)
 
     def encode_documents(self, documents, **kwargs):
         """
@@ -0,0 +1,88 @@
+from collections import OrderedDict
+import sqlite3
+
+import numpy as np
+
+
+class EmbeddingMemo:
+    def __init__(self, capacity=100000, path=None):
+        """
+        Bounded LRU memo of query embeddings, keyed by (model name, text), with
+        an optional on-disk key/value store shared across runs.
+
+        Parameters
+        ----------
+        capacity: int
+            The maximum number of embeddings kept in memory.
+
+        path: str
+            Path to a SQLite database used as a second level. Every new
+            embedding is written to it, and in-memory misses are looked up in it
+            before encoding. If None, the memo is in-memory only.
+        """
+        self.capacity = capacity
+        self.path = path
+        self._entries = OrderedDict()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, value BLOB)"
+            )
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(model_name, text):
+        return f"{model_name}\x00{text}"
+
+    def get_many(self, model_name, texts):
+        """
+        Returns
+        -------
+        list
+            For each text, its embedding (numpy.ndarray of float32) if it is
+            memoized, None otherwise.
+        """
+        keys = [self._key(model_name, text) for text in texts]
+        results = [self._entries.get(key) for key in keys]
+        for key, result in zip(keys, results):
+            if result is not None:
+                self._entries.move_to_end(key)
+
+        missing = [key for key, result in zip(keys, results) if result is None]
+        if self._db is not None and missing:
+            found = {}
+            # stay below SQLite's limit on the number of query parameters
+            for i in range(0, len(missing), 900):
+                chunk = missing[i:i + 900]
+                rows = self._db.execute(
+                    f"SELECT key, value FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+                found.update((key, np.frombuffer(value, dtype=np.float32)) for key, value in rows)
+            if found:
+                results = [found.get(key, result) if result is None else result for key, result in zip(keys, results)]
+                self._remember(found.items())
+        return results
+
+    def put_many(self, model_name, texts, embeddings):
+        items = [
+            (self._key(model_name, text), np.asarray(embedding, dtype=np.float32))
+            for text, embedding in zip(texts, embeddings)
+        ]
+        self._remember(items)
+        if self._db is not None:
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, value) VALUES (?, ?)",
+                    [(key, embedding.tobytes()) for key, embedding in items],
+                )
+
+    def _remember(self, items):
+        for key, embedding in items:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
@@ -1,4 +1,6 @@
 import abc
+import hashlib
+import os
 from pathlib import Path
 import sys
 from typing import Dict, List
@@ -71,6 +73,60 @@ class IndexBase(metaclass=abc.ABCMeta):
         """
         raise NotImplementedError(self.not_implemented_error)
 
+    def get_embeddings_from_indices(self, indices):
+        """
+        Get the embeddings of documents given their indices.
+
+        Parameters
+        ----------
+        indices: numpy.ndarray or list of ints
+            The indices of the documents, of shape (n,).
+
+        Returns
+        -------
+        numpy.ndarray
+            The embeddings of the documents, of shape (n, embedding_dim).
+
+        Notes
+        -----
+        This method is not implemented for all index types. For example,
+        it is not implemented for BM25.
+        """
+        raise NotImplementedError(self.not_implemented_error)
+
+    def fingerprint(self, n_samples=16):
+        """
+        Get an identifier of the contents of the index, e.g. to tag cached
+        search results with the index they came from.
+
+        Parameters
+        ----------
+        n_samples: int
+            The number of documents, evenly spread over the index, whose
+            embeddings are hashed along with the type and size of the index.
+
+        Returns
+        -------
+        int
+            A non-negative 60-bit hash. Rebuilding the index from the same
+            embeddings gives the same fingerprint.
+
+        Notes
+        -----
+        For index types that do not store embeddings (e.g. BM25), only the type
+        and size of the index are hashed.
+        """
+        digest = hashlib.sha1(f"{type(self).__name__}:{len(self)}".encode())
+        if len(self) > 0:
+            positions = np.linspace(0, len(self) - 1, min(n_samples, len(self))).astype(np.int64)
+            try:
+                embeddings = self.get_embeddings_from_indices(positions)
+            except NotImplementedError:
+                pass
+            else:
+                digest.update(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+        return int(digest.hexdigest()[:15], 16)
+
     @abc.abstractmethod
     def search(self, queries, k=10):
         """
@@ -96,7 +152,7 @@ class IndexBase(metaclass=abc.ABCMeta):
 
 
 class IndexTorchFlat(IndexBase):
-    def __init__(self, embeddings, sim_func="dot", device="auto"):
+    def __init__(self, embeddings, sim_func="dot", device="auto", block_size=65536, n_threads=None):
         """
         Parameters
         ----------
@@ -114,6 +170,16 @@ class IndexTorchFlat(IndexBase):
             The device to use when converting the embeddings to a torch tensor.
             If "auto", the device will be determined automatically. If None, the
             embeddings will not be moved to a device.
+
+        block_size: int
+            The number of documents scored at a time when searching. A running
+            top-k is kept per query across blocks, so the peak memory of a search
+            is (n_queries, block_size) scores, independent of the index size. If
+            None, all the documents are scored at once.
+
+        n_threads: int
+            The number of threads torch uses for a search on CPU. If None, the
+            current torch setting is used.
         """
         import torch
 
@@ -145,6 +211,8 @@ class IndexTorchFlat(IndexBase):
             raise ValueError(error_message)
 
         self.sim_func = sim_func
+        self.block_size = block_size
+        self.n_threads = n_threads
 
         if device == "auto":
             device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -168,11 +236,11 @@ class IndexTorchFlat(IndexBase):
         torch.save(self.index, directory / filename)
 
     @classmethod
-    def load(cls, directory="index", filename="flat.index.pt", device="auto"):
+    def load(cls, directory="index", filename="flat.index.pt", device="auto", **kwargs):
         import torch
 
         directory = Path(directory)
-        return cls(torch.load(directory / filename), device=device)
+        return cls(torch.load(directory / filename), device=device, **kwargs)
 
     def get_embeddings(self, start_ix=0, end_ix=-1):
         if end_ix == -1:
@@ -181,6 +249,12 @@ class IndexTorchFlat(IndexBase):
 
         return _to_np(self.index[start_ix:end_ix])
 
+    def get_embeddings_from_indices(self, indices):
+        import torch
+
+        indices = torch.as_tensor(np.asarray(indices, dtype=np.int64), device=self.index.device)
+        return _to_np(self.index[indices])
+
     def search(self, queries, k=10):
         import torch
 
@@ -189,11 +263,257 @@ class IndexTorchFlat(IndexBase):
         else:
             queries = torch.tensor(queries)
 
-        scores, indices = torch.topk(
-            self.sim_func(queries, self.index), k=k, dim=1, largest=True, sorted=True
-        )
+        n_threads = torch.get_num_threads()
+        if self.n_threads is not None:
+            torch.set_num_threads(self.n_threads)
+        try:
+            with torch.no_grad():
+                scores, indices = self._search_blocks(queries.to(self.index.device), k)
+        finally:
+            torch.set_num_threads(n_threads)
         return {"scores": _to_np(scores), "indices": _to_np(indices)}
 
+    def _search_blocks(self, queries, k):
+        """
+        Streaming top-k: score the documents block by block, and merge the top-k
+        of each block into the running top-k of each query.
+        """
+        import torch
+
+        block_size = self.block_size or len(self)
+        best_scores = best_indices = None
+        for start in range(0, len(self), block_size):
+            block_scores = self.sim_func(queries, self.index[start:start + block_size])
+            scores, indices = torch.topk(
+                block_scores, k=min(k, block_scores.shape[1]), dim=1, largest=True, sorted=True
+            )
+            indices += start
+            if best_scores is not None:
+                scores = torch.cat([best_scores, scores], dim=1)
+                indices = torch.cat([best_indices, indices], dim=1)
+                scores, order = torch.topk(scores, k=min(k, scores.shape[1]), dim=1, largest=True, sorted=True)
+                indices = torch.gather(indices, 1, order)
+            best_scores, best_indices = scores, indices
+        return best_scores, best_indices
+
+
+def _topk(scores, indices, k):
+    """
+    Returns the `k` largest scores of each row, sorted in decreasing order, and
+    the matching entries of `indices` (an array of the same shape as `scores`).
+    """
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        indices = np.take_along_axis(indices, part, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+def _merge_topk(scores, indices, k):
+    """
+    Merge lists of top-k results, e.g. of several blocks or shards of an index.
+
+    Parameters
+    ----------
+    scores: list of numpy.ndarray
+        The scores of each list, each of shape (n_queries, k_i).
+
+    indices: list of numpy.ndarray
+        The matching document indices, of the same shapes.
+
+    k: int
+        The number of results kept per query.
+
+    Returns
+    -------
+    scores, indices: numpy.ndarray
+        The `k` best results of each query over all the lists, of shape
+        (n_queries, min(k, sum of k_i)), sorted by decreasing score.
+    """
+    return _topk(np.concatenate(scores, axis=1), np.concatenate(indices, axis=1), k)
+
+
+class IndexMemmapFlat(IndexBase):
+    def __init__(self, embeddings, sim_func="dot", block_size=65536):
+        """
+        Exact (brute force) index whose embeddings are searched in place, block
+        by block, so that they can be a `numpy.memmap` of a file that does not
+        fit in memory. Loading the index only maps the file: it takes
+        milliseconds whatever the size of the index, blocks are read from the
+        page cache as the search goes, and processes of the same machine
+        searching the same file share one copy of it in the page cache.
+
+        The file is a plain .npy file of float32 or float16 embeddings (see
+        `save` and `build`). float16 halves the disk and page cache footprint;
+        blocks are converted to float32 before scoring.
+
+        Parameters
+        ----------
+        embeddings: numpy.ndarray
+            The embeddings of the documents in the index, of shape
+            (n_docs, dim). Usually a memory-mapped array, see `load`.
+
+        sim_func: str or callable
+            The similarity function, "dot" or "cosine", or a callable taking the
+            query and document embeddings (numpy arrays) and returning the
+            (n_queries, n_docs) similarity scores.
+
+        block_size: int
+            The number of documents scored at a time. A running top-k is kept
+            per query across blocks, so the peak memory of a search is
+            (n_queries, block_size) scores, independent of the index size.
+        """
+        error_message = f'Unknown similarity function {sim_func}. Use "cosine", "dot", or provide a function.'
+
+        if isinstance(sim_func, str):
+            if sim_func == "cosine":
+
+                def cosine(x, y):
+                    x = x / np.linalg.norm(x, axis=1, keepdims=True)
+                    return (x @ y.T) / np.linalg.norm(y, axis=1)
+
+                sim_func = cosine
+
+            elif sim_func in ["dot", "dot_product"]:
+
+                def dot(x, y):
+                    return x @ y.T
+
+                sim_func = dot
+
+            else:
+                raise ValueError(error_message)
+
+        if not callable(sim_func):
+            raise ValueError(error_message)
+
+        if embeddings.ndim != 2:
+            raise ValueError(f"embeddings must have shape (n_docs, dim). Got {embeddings.shape}.")
+
+        self.sim_func = sim_func
+        self.block_size = block_size
+        self.index = embeddings
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    @staticmethod
+    def build(chunks, n_docs, dim, directory="index", filename="flat.index.npy", dtype="float32"):
+        """
+        Write an index file chunk by chunk, without holding all the embeddings
+        in memory, e.g. while encoding a collection.
+
+        Parameters
+        ----------
+        chunks: iterable of numpy.ndarray or torch.Tensor
+            The embeddings of consecutive documents, each of shape (n, dim).
+
+        n_docs: int
+            The total number of documents in the chunks.
+
+        dim: int
+            The dimension of the embeddings.
+
+        directory: str
+            The directory to write the index file to.
+
+        filename: str
+            The name of the index file.
+
+        dtype: str
+            The dtype of the stored embeddings, "float32" or "float16".
+
+        Returns
+        -------
+        IndexMemmapFlat
+            The index, memory-mapped from the written file.
+        """
+        if np.dtype(dtype) not in (np.float32, np.float16):
+            raise ValueError(f'dtype must be "float32" or "float16". Got {dtype}.')
+
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        # write next to the destination and rename, so that the chunks may be
+        # read from the file being replaced (e.g. `save` onto the loaded file)
+        tmp_path = directory / f"{filename}.tmp"
+        out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=(n_docs, dim))
+        try:
+            start = 0
+            for chunk in chunks:
+                chunk = _to_np(chunk)
+                if start + len(chunk) > n_docs:
+                    raise ValueError(f"The chunks hold more than n_docs={n_docs} embeddings.")
+                out[start:start + len(chunk)] = chunk
+                start += len(chunk)
+            if start != n_docs:
+                raise ValueError(f"The chunks hold {start} embeddings, expected n_docs={n_docs}.")
+            out.flush()
+        except BaseException:
+            del out
+            os.remove(tmp_path)
+            raise
+        del out
+        os.replace(tmp_path, directory / filename)
+
+        return IndexMemmapFlat.load(directory, filename)
+
+    def save(self, directory="index", filename="flat.index.npy", dtype=None):
+        """
+        Save the embeddings to a .npy file, which `load` memory-maps. The file
+        is written next to its destination and then renamed, so it is safe to
+        save to the file the index was loaded from.
+
+        Parameters
+        ----------
+        directory: str
+            The directory to save the index to.
+
+        filename: str
+            The name of the index file.
+
+        dtype: str
+            The dtype of the stored embeddings, "float32" or "float16". If None,
+            the dtype of the embeddings is kept.
+        """
+        dtype = self.index.dtype if dtype is None else dtype
+        blocks = (
+            self.index[start:start + self.block_size]
+            for start in range(0, len(self), self.block_size)
+        )
+        self.build(blocks, len(self), self.index.shape[1], directory, filename, dtype)
+
+    @classmethod
+    def load(cls, directory="index", filename="flat.index.npy", **kwargs):
+        directory = Path(directory)
+        return cls(np.load(directory / filename, mmap_mode="r"), **kwargs)
+
+    def get_embeddings(self, start_ix=0, end_ix=-1):
+        if end_ix == -1:
+            end_ix = len(self)
+        end_ix = min(end_ix, len(self))
+
+        return np.asarray(self.index[start_ix:end_ix], dtype=np.float32)
+
+    def get_embeddings_from_indices(self, indices):
+        return np.asarray(self.index[np.asarray(indices, dtype=np.int64)], dtype=np.float32)
+
+    def search(self, queries, k=10):
+        queries = np.asarray(_to_np(queries), dtype=np.float32)
+
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        best_indices = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self), self.block_size):
+            block = np.asarray(self.index[start:start + self.block_size], dtype=np.float32)
+            scores = np.asarray(self.sim_func(queries, block), dtype=np.float32)
+            indices = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+            best_scores, best_indices = _merge_topk(
+                [best_scores, scores], [best_indices, indices], k
+            )
+
+        return {"scores": best_scores, "indices": best_indices}
+
 
 class IndexFaissFlatIP(IndexBase):
     def __init__(self, embeddings):
@@ -215,7 +535,10 @@ class IndexFaissFlatIP(IndexBase):
             end_ix = self.index.ntotal
         end_ix = min(end_ix, self.index.ntotal)
 
-        return self.index.reconstruct_n(start_ix, end_ix)
+        return self.index.reconstruct_n(start_ix, end_ix - start_ix)
+
+    def get_embeddings_from_indices(self, indices):
+        return self.index.reconstruct_batch(np.asarray(indices, dtype=np.int64))
 
     def save(self, directory="index", filename="flat.index.faiss"):
         import faiss
@@ -242,17 +565,140 @@ class IndexFaissFlatIP(IndexBase):
 
 
 class IndexFaissHNSW(IndexFaissFlatIP):
-    def __init__(self, embeddings, store_n=512, ef_search=128, ef_construction=200):
+    def __init__(
+        self,
+        embeddings,
+        store_n=512,
+        ef_search=128,
+        ef_construction=200,
+        dim=None,
+        max_norm=None,
+        chunk_size=65536,
+        show_progress=True,
+    ):
+        """
+        HNSW graph index for maximum inner product search, as built by DPR. HNSW
+        searches by L2 distance, so every embedding `x` is stored with an extra
+        dimension `sqrt(max_norm**2 - ||x||**2)`, where `max_norm` is the largest
+        norm of the embeddings, and queries get an extra 0: the L2 distance
+        between them is then `||q||**2 + max_norm**2 - 2 q.x`, which ranks the
+        documents by inner product. The returned scores are these distances,
+        so lower is better.
+
+        Parameters
+        ----------
+        embeddings: numpy.ndarray, torch.Tensor, iterable or faiss.IndexHNSWFlat
+            Either a faiss index (e.g. a downloaded DPR index), used directly,
+            or the embeddings of the documents, added in chunks (see `add`).
+
+        store_n: int
+            The number of neighbors of each node of the graph.
+
+        ef_search: int
+            The size of the candidate list during search.
+
+        ef_construction: int
+            The size of the candidate list while building the graph.
+
+        dim: int
+            The dimension of the embeddings, required if they are given as an
+            iterable of chunks.
+
+        max_norm: float
+            The largest norm of the embeddings. If None, it is computed from the
+            embeddings, which requires them to be an array and not an iterable.
+
+        chunk_size: int
+            The number of embeddings added to the index at a time.
+
+        show_progress: bool
+            Whether to show a progress bar while adding the embeddings.
+        """
         import faiss
 
         if isinstance(embeddings, faiss.IndexHNSWFlat):
             self.index = embeddings
+            self._max_norm = max_norm
         else:
-            index = faiss.IndexHNSWFlat(embeddings.shape[1] + 1, store_n)
+            if dim is None:
+                dim = embeddings.shape[1]
+            index = faiss.IndexHNSWFlat(dim + 1, store_n)
             index.hnsw.efSearch = ef_search
             index.hnsw.efConstruction = ef_construction
             self.index = index
-            # TODO: load index from embeddings
+            self._max_norm = max_norm
+            self.add(embeddings, chunk_size=chunk_size, show_progress=show_progress)
+
+    @property
+    def max_norm(self):
+        """
+        The norm used for the auxiliary dimension. Every stored vector has this
+        norm, so for an index built elsewhere it is read from the first one.
+        """
+        if self._max_norm is None and self.index.ntotal > 0:
+            self._max_norm = float(np.linalg.norm(self.index.reconstruct(0)))
+        return self._max_norm
+
+    def add(self, embeddings, chunk_size=65536, show_progress=True):
+        """
+        Add embeddings to the index, with their auxiliary dimension.
+
+        Parameters
+        ----------
+        embeddings: numpy.ndarray, torch.Tensor or iterable
+            Either an array of shape (n, dim), which can be memory-mapped (it is
+            read `chunk_size` rows at a time), or an iterable of such arrays,
+            e.g. a generator encoding the collection batch by batch. The norms
+            of the embeddings must not exceed `max_norm`; if it is not known
+            yet, it is computed from the array, and must have been given to the
+            constructor when adding from an iterable.
+
+        chunk_size: int
+            The number of embeddings added at a time, for arrays.
+
+        show_progress: bool
+            Whether to show a progress bar.
+        """
+        from tqdm.auto import tqdm
+
+        if hasattr(embeddings, "shape"):
+            total = len(embeddings)
+            starts = range(0, total, chunk_size)
+            if self.max_norm is None:
+                self._max_norm = max(
+                    (
+                        float(np.linalg.norm(_to_np(embeddings[start:start + chunk_size]), axis=1).max())
+                        for start in starts
+                    ),
+                    default=0.0,
+                )
+            chunks = (embeddings[start:start + chunk_size] for start in starts)
+        else:
+            total = None
+            chunks = embeddings
+            if self.max_norm is None:
+                raise ValueError("max_norm must be given to add embeddings from an iterable.")
+
+        with tqdm(total=total, unit="vectors", disable=not show_progress, desc="Adding to HNSW") as progress:
+            for chunk in chunks:
+                self.index.add(self._augment(chunk))
+                progress.update(len(chunk))
+
+    def _augment(self, embeddings):
+        """Append the auxiliary dimension sqrt(max_norm**2 - ||x||**2) to embeddings."""
+        embeddings = np.asarray(_to_np(embeddings), dtype=np.float32)
+        sq_norms = np.einsum("ij,ij->i", embeddings, embeddings)
+        max_sq_norm = self.max_norm**2
+        # allow for rounding errors on the largest norms
+        if sq_norms.size and sq_norms.max() > max_sq_norm * (1 + 1e-5):
+            raise ValueError(
+                f"Embedding of norm {np.sqrt(sq_norms.max()):.4f} exceeds max_norm={self.max_norm:.4f}."
+            )
+        aux_dim = np.sqrt(np.maximum(max_sq_norm - sq_norms, 0.0)).astype(np.float32)
+        return np.ascontiguousarray(np.hstack((embeddings, aux_dim[:, None])))
+
+    def save(self, directory="index", filename="hnsw.index.faiss"):
+        super().save(directory, filename)
 
     @classmethod
     def load(cls, directory="index", filename="hnsw.index.faiss"):
@@ -262,6 +708,13 @@ class IndexFaissHNSW(IndexFaissFlatIP):
         index = faiss.read_index(str(directory / filename))
         return cls(index)
 
+    def get_embeddings(self, start_ix=0, end_ix=-1):
+        # drop the auxiliary dimension used to turn inner product into L2
+        return super().get_embeddings(start_ix, end_ix)[:, :-1]
+
+    def get_embeddings_from_indices(self, indices):
+        return super().get_embeddings_from_indices(indices)[:, :-1]
+
     def search(self, queries, k=10):
         if not isinstance(queries, np.ndarray):
             queries = np.array(queries)
@@ -274,6 +727,397 @@ class IndexFaissHNSW(IndexFaissFlatIP):
         return {"scores": scores, "indices": indices}
 
 
+class IndexFaissIVFPQ(IndexFaissFlatIP):
+    def __init__(
+        self,
+        embeddings,
+        n_lists=4096,
+        n_subquantizers=64,
+        n_bits=8,
+        nprobe=16,
+        rescore_index=None,
+        rescore_factor=4,
+        max_train=None,
+        chunk_size=65536,
+    ):
+        """
+        Inverted file index with product-quantized embeddings (IVF-PQ), for
+        maximum inner product search. Each embedding is stored as
+        `n_subquantizers` codes of `n_bits` bits, e.g. 64 bytes instead of 3KB
+        for a 768-dimensional float32 embedding, and a search only scans the
+        `nprobe` inverted lists closest to the query.
+
+        Scores of the compressed embeddings are approximate. If a
+        `rescore_index` holding the exact embeddings is given (typically an
+        `IndexMemmapFlat`, which keeps them on disk), the search retrieves
+        `rescore_factor * k` candidates and returns the `k` best by exact
+        inner product.
+
+        Parameters
+        ----------
+        embeddings: numpy.ndarray, torch.Tensor or faiss.Index
+            Either an IVF-PQ faiss index, used directly, or the embeddings of
+            the documents, which are used to train a new index and then added
+            to it.
+
+        n_lists: int
+            The number of inverted lists (coarse clusters).
+
+        n_subquantizers: int
+            The number of PQ codes per embedding. It must divide the dimension
+            of the embeddings.
+
+        n_bits: int
+            The number of bits per PQ code.
+
+        nprobe: int
+            The number of inverted lists scanned per query. Higher is more
+            accurate and slower.
+
+        rescore_index: instruct_qa.retrieval.index.IndexBase
+            An index returning the exact embeddings of the documents with
+            `get_embeddings_from_indices`. If None, the approximate scores are
+            returned.
+
+        rescore_factor: int
+            The number of candidates re-scored per query, as a multiple of k.
+
+        max_train: int
+            The maximum number of embeddings used for training, sampled at
+            random. Defaults to 256 times `n_lists`.
+
+        chunk_size: int
+            The number of embeddings added to the index at a time.
+        """
+        import faiss
+
+        self.rescore_index = rescore_index
+        self.rescore_factor = rescore_factor
+
+        if isinstance(embeddings, faiss.Index):
+            self.index = embeddings
+        else:
+            dim = embeddings.shape[1]
+            quantizer = faiss.IndexFlatIP(dim)
+            self.index = faiss.IndexIVFPQ(
+                quantizer, dim, n_lists, n_subquantizers, n_bits, faiss.METRIC_INNER_PRODUCT
+            )
+            self.train(embeddings, max_train=max_train)
+            self.add(embeddings, chunk_size=chunk_size)
+
+        self.nprobe = nprobe
+
+    @property
+    def nprobe(self):
+        import faiss
+
+        return faiss.extract_index_ivf(self.index).nprobe
+
+    @nprobe.setter
+    def nprobe(self, value):
+        import faiss
+
+        faiss.extract_index_ivf(self.index).nprobe = value
+
+    def train(self, embeddings, max_train=None, seed=0):
+        """
+        Train the coarse quantizer and the product quantizer.
+
+        Parameters
+        ----------
+        embeddings: numpy.ndarray or torch.Tensor
+            The training embeddings, of shape (n, dim).
+
+        max_train: int
+            The maximum number of embeddings used, sampled at random. Defaults
+            to 256 times the number of inverted lists.
+
+        seed: int
+            Seed of the sampling.
+        """
+        n_lists = self.index.nlist
+        max_train = 256 * n_lists if max_train is None else max_train
+        if len(embeddings) > max_train:
+            rng = np.random.default_rng(seed)
+            sample = np.sort(rng.choice(len(embeddings), max_train, replace=False))
+            embeddings = embeddings[sample]
+        self.index.train(np.ascontiguousarray(_to_np(embeddings), dtype=np.float32))
+
+    def add(self, embeddings, chunk_size=65536):
+        """
+        Add embeddings to a trained index, `chunk_size` at a time, so that they
+        can be a memory-mapped array.
+        """
+        if not self.index.is_trained:
+            raise ValueError("The index must be trained before adding embeddings. Use `train`.")
+        for start in range(0, len(embeddings), chunk_size):
+            chunk = _to_np(embeddings[start:start + chunk_size])
+            self.index.add(np.ascontiguousarray(chunk, dtype=np.float32))
+
+    def get_embeddings(self, start_ix=0, end_ix=-1):
+        self._make_direct_map()
+        return super().get_embeddings(start_ix, end_ix)
+
+    def get_embeddings_from_indices(self, indices):
+        self._make_direct_map()
+        return super().get_embeddings_from_indices(indices)
+
+    def _make_direct_map(self):
+        """Reconstructing embeddings (approximately) from their ids requires a direct map."""
+        import faiss
+
+        ivf = faiss.extract_index_ivf(self.index)
+        if ivf.direct_map.type == faiss.DirectMap.NoMap:
+            ivf.make_direct_map()
+
+    def save(self, directory="index", filename="ivfpq.index.faiss"):
+        super().save(directory, filename)
+
+    @classmethod
+    def load(cls, directory="index", filename="ivfpq.index.faiss", nprobe=None, **kwargs):
+        import faiss
+
+        directory = Path(directory)
+        index = faiss.read_index(str(directory / filename))
+        if nprobe is None:
+            nprobe = faiss.extract_index_ivf(index).nprobe
+        return cls(index, nprobe=nprobe, **kwargs)
+
+    def search(self, queries, k=10):
+        queries = np.ascontiguousarray(_to_np(queries), dtype=np.float32)
+
+        if self.rescore_index is None:
+            scores, indices = self.index.search(queries, k=k)
+            return {"scores": scores, "indices": indices}
+
+        _, candidates = self.index.search(queries, k=k * self.rescore_factor)
+        found = candidates >= 0
+        embeddings = self.rescore_index.get_embeddings_from_indices(candidates[found])
+        scores = np.full(candidates.shape, -np.inf, dtype=np.float32)
+        scores[found] = np.einsum(
+            "ij,ij->i", np.repeat(queries, found.sum(axis=1), axis=0), embeddings
+        )
+        scores, indices = _topk(scores, candidates, k)
+        return {"scores": scores, "indices": indices}
+
+
+_WORKER_SHARD = None
+
+
+def _init_shard_worker(class_name, directory, filename):
+    global _WORKER_SHARD
+    _WORKER_SHARD = getattr(sys.modules[__name__], class_name).load(directory, filename)
+
+
+def _search_shard_worker(queries, k):
+    return _WORKER_SHARD.search(queries, k=k)
+
+
+class IndexSharded(IndexBase):
+    def __init__(self, shards, n_workers=None):
+        """
+        Index split into shards, each holding a contiguous range of documents:
+        shard `i` holds the documents `offsets[i]` to `offsets[i + 1] - 1`. A
+        search runs on all the shards concurrently, in a thread pool (faiss and
+        numpy release the GIL), and the top-k of the shards are merged.
+
+        Shards can also be searched in worker processes, one per shard, if the
+        index is loaded with `load(..., use_processes=True)`.
+
+        Parameters
+        ----------
+        shards: list of instruct_qa.retrieval.index.IndexBase
+            The shards, in document order. Either all or none of them must be
+            `IndexFaissHNSW` indexes, whose scores are distances (lower is
+            better), since scores of both kinds cannot be merged. The distances
+            of HNSW shards with different `max_norm` are made comparable before
+            merging.
+
+        n_workers: int
+            The number of threads searching the shards. Defaults to one per
+            shard.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if len(shards) == 0:
+            raise ValueError("An IndexSharded needs at least one shard.")
+        n_distances = sum(isinstance(shard, IndexFaissHNSW) for shard in shards)
+        if 0 < n_distances < len(shards):
+            raise ValueError("Cannot merge the distances of HNSW shards with the scores of other shards.")
+
+        self.shards = list(shards)
+        self.offsets = np.concatenate([[0], np.cumsum([len(shard) for shard in self.shards])])
+        self.lower_is_better = n_distances > 0
+        self._executor = ThreadPoolExecutor(max_workers=n_workers or len(self.shards))
+        self._processes = None
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @classmethod
+    def build(cls, embeddings, n_shards, index_cls, n_workers=None, **kwargs):
+        """
+        Build a sharded index from embeddings, building the shards concurrently.
+
+        Parameters
+        ----------
+        embeddings: numpy.ndarray or torch.Tensor
+            The embeddings of the documents, of shape (n_docs, dim). It can be a
+            memory-mapped array.
+
+        n_shards: int
+            The number of shards, of (almost) equal sizes.
+
+        index_cls: type
+            The index class of the shards, e.g. `IndexFaissHNSW`.
+
+        n_workers: int
+            The number of threads building and searching the shards. Defaults
+            to one per shard.
+
+        **kwargs: dict
+            Additional keyword arguments passed to `index_cls`.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        bounds = np.linspace(0, len(embeddings), n_shards + 1).astype(np.int64)
+        with ThreadPoolExecutor(max_workers=n_workers or n_shards) as executor:
+            shards = list(
+                executor.map(
+                    lambda i: index_cls(embeddings[bounds[i]:bounds[i + 1]], **kwargs),
+                    range(n_shards),
+                )
+            )
+        return cls(shards, n_workers=n_workers)
+
+    def save(self, directory="index", filename="sharded.index.json"):
+        """
+        Save each shard next to a JSON manifest listing the shards, named
+        `<filename>.shard<i>`.
+        """
+        import json
+
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        manifest = []
+        for i, shard in enumerate(self.shards):
+            shard_filename = f"{filename}.shard{i}"
+            shard.save(directory, shard_filename)
+            manifest.append({"class": type(shard).__name__, "filename": shard_filename})
+        with open(directory / filename, "w") as f:
+            json.dump({"shards": manifest}, f, indent=2)
+
+    @classmethod
+    def load(cls, directory="index", filename="sharded.index.json", n_workers=None, use_processes=False):
+        """
+        Load a sharded index saved with `save`.
+
+        Parameters
+        ----------
+        directory: str
+            The directory to load the index from.
+
+        filename: str
+            The name of the manifest file.
+
+        n_workers: int
+            The number of threads searching the shards. Defaults to one per
+            shard.
+
+        use_processes: bool
+            If True, every shard is also loaded in its own worker process, which
+            runs the searches of that shard. This avoids contention on the GIL
+            for shards whose search holds it (e.g. `IndexTorchFlat` on CPU),
+            at the cost of the memory of a second copy of the shards, except
+            for memory-mapped ones.
+        """
+        import json
+        from concurrent.futures import ProcessPoolExecutor
+
+        with open(Path(directory) / filename) as f:
+            manifest = json.load(f)["shards"]
+
+        this_module = sys.modules[__name__]
+        shards = [getattr(this_module, spec["class"]).load(directory, spec["filename"]) for spec in manifest]
+        index = cls(shards, n_workers=n_workers)
+        if use_processes:
+            index._processes = [
+                ProcessPoolExecutor(
+                    max_workers=1,
+                    initializer=_init_shard_worker,
+                    initargs=(spec["class"], str(directory), spec["filename"]),
+                )
+                for spec in manifest
+            ]
+        return index
+
+    def close(self):
+        """Shut down the threads and worker processes of the index."""
+        self._executor.shutdown()
+        for process in self._processes or []:
+            process.shutdown()
+        self._processes = None
+
+    def _locate(self, indices):
+        """Returns the shard of each document index and its index within the shard."""
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) and (indices.min() < 0 or indices.max() >= len(self)):
+            raise ValueError(f"Document indices must be in [0, {len(self)}).")
+        shard_ids = np.searchsorted(self.offsets, indices, side="right") - 1
+        return shard_ids, indices - self.offsets[shard_ids]
+
+    def get_embeddings(self, start_ix=0, end_ix=-1):
+        if end_ix == -1:
+            end_ix = len(self)
+        end_ix = min(end_ix, len(self))
+
+        return self.get_embeddings_from_indices(np.arange(start_ix, end_ix))
+
+    def get_embeddings_from_indices(self, indices):
+        shard_ids, local = self._locate(indices)
+        embeddings = None
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            found = self.shards[shard_id].get_embeddings_from_indices(local[mask])
+            if embeddings is None:
+                embeddings = np.zeros((len(shard_ids), found.shape[1]), dtype=found.dtype)
+            embeddings[mask] = found
+        if embeddings is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return embeddings
+
+    def search(self, queries, k=10):
+        queries = np.asarray(_to_np(queries), dtype=np.float32)
+
+        if self._processes is not None:
+            futures = [process.submit(_search_shard_worker, queries, k) for process in self._processes]
+        else:
+            futures = [self._executor.submit(shard.search, queries, k=k) for shard in self.shards]
+
+        if self.lower_is_better:
+            # HNSW distances include the max_norm of their shard: shift them to
+            # the distances with the largest max_norm, so they are comparable
+            sq_norms = np.array([shard.max_norm or 0.0 for shard in self.shards]) ** 2
+            shifts = sq_norms.max() - sq_norms
+
+        all_scores, all_indices = [], []
+        for i, (offset, future) in enumerate(zip(self.offsets, futures)):
+            results = future.result()
+            indices = np.asarray(results["indices"], dtype=np.int64)
+            scores = np.asarray(results["scores"], dtype=np.float32)
+            if self.lower_is_better:
+                scores = -(scores + shifts[i])
+            # padding of shards with fewer than k documents goes last
+            missing = indices < 0
+            all_scores.append(np.where(missing, -np.inf, scores))
+            all_indices.append(np.where(missing, -1, indices + offset))
+
+        scores, indices = _merge_topk(all_scores, all_indices, k)
+        if self.lower_is_better:
+            scores = -scores
+        return {"scores": scores, "indices": indices}
+
+
 class IndexPyseriniBM25(IndexBase):
     def __init__(self, searcher):
         """
@@ -3,7 +3,13 @@ from typing import Dict, List
 
 import instruct_qa.experiment_utils as utils
 from instruct_qa.retrieval import RetrieverFromFile, SentenceTransformerRetriever
-from instruct_qa.retrieval.index import IndexFaissFlatIP, IndexFaissHNSW
+from instruct_qa.retrieval.index import (
+    IndexFaissFlatIP,
+    IndexFaissHNSW,
+    IndexFaissIVFPQ,
+    IndexMemmapFlat,
+    IndexSharded,
+)
 
 INDEX_NAME_TO_PATH_URL = {
     "dpr-nq-multi-hnsw": {
@@ -14,6 +20,11 @@ INDEX_NAME_TO_PATH_URL = {
         "url": "https://instruct-qa.s3.us-east-2.amazonaws.com/indexes/dpr/topiocqa/single/hnsw/index.dpr",
         "path": "data/topiocqa/index/hnsw/index.dpr",
     },
+    # no prebuilt file is hosted: build it with IndexFaissIVFPQ(...).save(...)
+    "dpr-nq-multi-ivfpq": {
+        "url": None,
+        "path": "data/nq/index/ivfpq/ivfpq.index.faiss",
+    },
 }
 
 
@@ -223,7 +234,8 @@ def load_index(index_name, **kwargs):
     Parameters
     ----------
     index_name (str): Name of index to load.
-    kwargs: Additional parameters for the index (e.g., index_path).
+    kwargs: Additional parameters for the index (e.g., index_path, or nprobe for
+        IVF-PQ indexes).
 
     Returns
     -------
@@ -234,13 +246,35 @@ def load_index(index_name, **kwargs):
     if index_path is None:
         index_path = INDEX_NAME_TO_PATH_URL[index_name]["path"]
         if not os.path.exists(index_path):
+            if INDEX_NAME_TO_PATH_URL[index_name]["url"] is None:
+                raise ValueError(
+                    f"Index {index_name} is not hosted and was not found at {index_path}. "
+                    "Build it locally, or provide its index_path."
+                )
             utils.wget(
                 INDEX_NAME_TO_PATH_URL[index_name]["url"],
                 index_path,
             )
 
     print("Loading index...")
-    if "hnsw" in index_name:
+    if "sharded" in index_name:
+        return IndexSharded.load(
+            directory=os.path.dirname(index_path),
+            filename=os.path.basename(index_path),
+            use_processes=kwargs.get("use_processes", False),
+        )
+    elif "memmap" in index_name:
+        return IndexMemmapFlat.load(
+            directory=os.path.dirname(index_path),
+            filename=os.path.basename(index_path),
+        )
+    elif "ivfpq" in index_name:
+        return IndexFaissIVFPQ.load(
+            directory=os.path.dirname(index_path),
+            filename=os.path.basename(index_path),
+            nprobe=kwargs.get("nprobe", None),
+        )
+    elif "hnsw" in index_name:
         return IndexFaissHNSW.load(
             directory=os.path.dirname(index_path),
             filename=os.path.basename(index_path),
@@ -252,13 +286,14 @@ def load_index(index_name, **kwargs):
         )
 
 
-def load_retriever(model_name, index, retriever_cached_results_fp=None):
+def load_retriever(model_name, index, retriever_cached_results_fp=None, embedding_memo=None):
     """
     Loads retriever by name.
 
     Args:
         model_name (str): Name of query model to load from sentence_transformers
         kwargs: Additional parameters for the retriever (e.g., index_path).
+        embedding_memo (EmbeddingMemo): Optional memo of query embeddings.
 
     Returns:
         BaseRetriever: Retriever object.
@@ -269,4 +304,6 @@ def load_retriever(model_name, index, retriever_cached_results_fp=None):
     from sentence_transformers import SentenceTransformer
 
     query_model = SentenceTransformer(model_name)
-    return SentenceTransformerRetriever(query_model, index=index)
+    return SentenceTransformerRetriever(
+        query_model, index=index, embedding_memo=embedding_memo, model_name=model_name
+    )
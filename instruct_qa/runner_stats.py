@@ -0,0 +1,221 @@
+from pathlib import Path
+import warnings
+
+import numpy as np
+
+# How each query was answered
+MISS = 0
+TEXT_HIT = 1
+CACHE_HIT = 2
+COALESCED = 3
+
+TIER_NAMES = {MISS: "miss", TEXT_HIT: "text_hit", CACHE_HIT: "cache_hit", COALESCED: "coalesced"}
+
+QUERY_FIELDS = {
+    "batch": np.int64,
+    "tier": np.int8,
+    "nn_distance": np.float32,
+    "answer_hit": np.bool_,
+}
+
+BATCH_FIELDS = {
+    "n_queries": np.int64,
+    "encoding": np.float64,
+    "search": np.float64,
+    "fetch_doc": np.float64,
+    "generation": np.float64,
+    "avg_dist": np.float64,
+    "tolerance": np.float64,
+    "searches_saved": np.int64,
+    "evictions": np.int64,
+    "rejections": np.int64,
+    "generation_saved": np.float64,
+}
+
+STAGES = ["encoding", "search", "fetch_doc", "generation"]
+
+
+class _Column:
+    """Append-only NumPy array with amortized O(1) appends."""
+
+    def __init__(self, dtype, capacity=1024):
+        self._data = np.empty(capacity, dtype=dtype)
+        self._size = 0
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self._data.dtype).ravel()
+        end = self._size + len(values)
+        if end > len(self._data):
+            data = np.empty(max(end, 2 * len(self._data)), dtype=self._data.dtype)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+        self._data[self._size:end] = values
+        self._size = end
+
+    @property
+    def values(self):
+        return self._data[:self._size]
+
+
+def _missing(dtype):
+    return np.nan if np.issubdtype(dtype, np.floating) else -1
+
+
+class RunnerStats:
+    def __init__(self):
+        """
+        Statistics of a `ResponseRunner` run, stored column-wise in NumPy arrays:
+
+        - one record per query: the batch it belongs to, how it was answered
+          (`tier`, see `TIER_NAMES`), the distance to its nearest cached key
+          and whether its answer came from the answer cache.
+        - one record per batch: the latency of each stage (in seconds), the
+          average query-to-passage distance, the cache tolerance, the number of
+          index searches saved by coalescing, the number of cache evictions and
+          the number of entries rejected by the cache admission filter, and the
+          estimated generation time saved by the answer cache.
+
+        Missing batch fields (e.g. retrieval stages when RAG is disabled) are
+        NaN for float fields and -1 for integer fields.
+        """
+        self._queries = {name: _Column(dtype) for name, dtype in QUERY_FIELDS.items()}
+        self._batches = {name: _Column(dtype) for name, dtype in BATCH_FIELDS.items()}
+        self._n_batches = 0
+
+    def __len__(self):
+        return len(self._queries["batch"].values)
+
+    def add_batch(self, n_queries, tiers=None, nn_distance=None, answer_hits=None, **batch_fields):
+        """
+        Record a batch.
+
+        Parameters
+        ----------
+        n_queries: int
+            The number of queries in the batch.
+
+        tiers: numpy.ndarray
+            How each query was answered, of shape (n_queries,). Defaults to MISS.
+
+        nn_distance: numpy.ndarray
+            The distance of each query to its nearest cached key, of shape
+            (n_queries,). Defaults to NaN.
+
+        answer_hits: numpy.ndarray
+            Whether each answer came from the answer cache, of shape
+            (n_queries,). Defaults to False.
+
+        **batch_fields: dict
+            Values of the batch fields listed in `BATCH_FIELDS`.
+        """
+        unknown = set(batch_fields) - set(BATCH_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown batch fields: {sorted(unknown)}.")
+
+        self._queries["batch"].extend(np.full(n_queries, self._n_batches))
+        self._queries["tier"].extend(np.full(n_queries, MISS) if tiers is None else tiers)
+        self._queries["nn_distance"].extend(np.full(n_queries, np.nan) if nn_distance is None else nn_distance)
+        self._queries["answer_hit"].extend(np.zeros(n_queries, dtype=bool) if answer_hits is None else answer_hits)
+
+        batch_fields["n_queries"] = n_queries
+        for name, dtype in BATCH_FIELDS.items():
+            value = batch_fields.get(name)
+            self._batches[name].extend([_missing(dtype) if value is None else value])
+        self._n_batches += 1
+
+    @property
+    def queries(self):
+        """dict of numpy.ndarray: the per-query columns."""
+        return {name: column.values for name, column in self._queries.items()}
+
+    @property
+    def batches(self):
+        """dict of numpy.ndarray: the per-batch columns."""
+        return {name: column.values for name, column in self._batches.items()}
+
+    @property
+    def hit_rate(self):
+        tiers = self._queries["tier"].values
+        return float(np.isin(tiers, [TEXT_HIT, CACHE_HIT]).mean()) if len(tiers) else float("nan")
+
+    def summary(self, percentiles=(50, 95, 99)):
+        """
+        Returns
+        -------
+        dict
+            The number of queries and batches, the fraction of queries answered
+            by each retrieval tier, the overall retrieval hit rate, the answer
+            cache hit rate, the total number of searches saved, evictions and
+            rejections, the estimated generation time saved, and the given percentiles of each stage latency
+            per batch (e.g. "search_p95").
+        """
+        tiers = self._queries["tier"].values
+        counts = np.bincount(tiers, minlength=len(TIER_NAMES)) if len(tiers) else np.zeros(len(TIER_NAMES))
+        summary = {
+            "n_queries": len(tiers),
+            "n_batches": self._n_batches,
+            "hit_rate": self.hit_rate,
+            "answer_hit_rate": float(self._queries["answer_hit"].values.mean()) if len(tiers) else float("nan"),
+        }
+        for tier, name in TIER_NAMES.items():
+            summary[f"{name}_rate"] = float(counts[tier] / max(len(tiers), 1))
+
+        batches = self.batches
+        for name in ["searches_saved", "evictions", "rejections"]:
+            summary[name] = int(batches[name][batches[name] >= 0].sum())
+        summary["generation_saved"] = float(np.nansum(batches["generation_saved"]))
+
+        latencies = np.stack([batches[stage] for stage in STAGES])
+        if self._n_batches > 0:
+            with warnings.catch_warnings():
+                # stages that never ran (e.g. retrieval without RAG) are all NaN
+                warnings.simplefilter("ignore", RuntimeWarning)
+                values = np.nanpercentile(latencies, percentiles, axis=1)
+        else:
+            values = np.full((len(percentiles), len(STAGES)), np.nan)
+        for i, p in enumerate(percentiles):
+            for j, stage in enumerate(STAGES):
+                summary[f"{stage}_p{p}"] = float(values[i, j])
+        return summary
+
+    def save_npz(self, path):
+        """Save the per-query and per-batch columns to an .npz file."""
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            path,
+            **{f"query_{name}": values for name, values in self.queries.items()},
+            **{f"batch_{name}": values for name, values in self.batches.items()},
+        )
+
+    @classmethod
+    def load_npz(cls, path):
+        stats = cls()
+        with np.load(path) as data:
+            for name in QUERY_FIELDS:
+                stats._queries[name].extend(data[f"query_{name}"])
+            for name in BATCH_FIELDS:
+                stats._batches[name].extend(data[f"batch_{name}"])
+        stats._n_batches = len(stats._batches["n_queries"].values)
+        return stats
+
+    def to_pandas(self):
+        """
+        Returns
+        -------
+        pandas.DataFrame
+            One row per query, with the fields of its batch prefixed by "batch_".
+        """
+        import pandas as pd
+
+        queries = self.queries
+        batches = self.batches
+        columns = dict(queries)
+        columns.update(
+            {f"batch_{name}": values[queries["batch"]] for name, values in batches.items()}
+        )
+        return pd.DataFrame(columns)
+
+    def save_parquet(self, path):
+        """Save the per-query table of `to_pandas` to a Parquet file (requires pyarrow)."""
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.to_pandas().to_parquet(path, index=False)